@@ -1,11 +1,13 @@
 from logic import *
 
 
+@truth_table
 def HalfAdder(a, b):
     sm = Xor(a, b)
     cr = And(a, b)
     return sm, cr
 
+@truth_table
 def FullAdder(a, b, c):
     s0, c0 = HalfAdder(a, b)
     sm, c1 = HalfAdder(s0, c)
@@ -37,7 +39,249 @@ def Inc16(inp):
     return Add16(inp,
                  (0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1))
 
-def ALU(x, y, zx, nx, zy, ny, f, no):
+
+##########################################################
+# Faster adders
+#
+# Add16 above is a ripple-carry adder: the carry out of
+# each FullAdder feeds the next, so the longest path
+# through the chip grows linearly with the width. The
+# adders below compute the same sums with shorter paths
+# at the cost of extra gates, and any of them can be
+# passed to ALU in place of Add16. Run netlist.py for
+# their Nand counts and logical depths.
+#
+# Inside these adders it is easier to think in lanes
+# counted from the least significant bit, so lane i
+# holds a[15 - i]. A lane generates a carry when both of
+# its inputs are 1 and propagates an incoming carry when
+# exactly one of them is.
+##########################################################
+
+def GeneratePropagate(a, b):
+    g = And(a, b)
+    p = Xor(a, b)
+    return g, p
+
+def GroupGeneratePropagate4(g0, p0, g1, p1, g2, p2, g3, p3):
+    # Whether four consecutive lanes, taken as one block,
+    # generate or propagate a carry
+    gg = Or(Or(g3, And(p3, g2)),
+            Or(And(And(p3, p2), g1),
+               And(And(p3, p2), And(p1, g0))))
+    pg = And(And(p3, p2), And(p1, p0))
+    return gg, pg
+
+def LookaheadCarry4(g0, p0, g1, p1, g2, p2, c0):
+    # Carries into lanes 1, 2 and 3 of a block, each computed
+    # directly from the carry into lane 0 instead of rippling
+    c1 = Or(g0, And(p0, c0))
+    c2 = Or(Or(g1, And(p1, g0)),
+            And(And(p1, p0), c0))
+    c3 = Or(Or(g2, And(p2, g1)),
+            Or(And(And(p2, p1), g0),
+               And(And(p2, p1), And(p0, c0))))
+    return c1, c2, c3
+
+def CarryLookaheadAdd16(a, b):
+    g0,  p0  = GeneratePropagate(a[15], b[15])
+    g1,  p1  = GeneratePropagate(a[14], b[14])
+    g2,  p2  = GeneratePropagate(a[13], b[13])
+    g3,  p3  = GeneratePropagate(a[12], b[12])
+    g4,  p4  = GeneratePropagate(a[11], b[11])
+    g5,  p5  = GeneratePropagate(a[10], b[10])
+    g6,  p6  = GeneratePropagate(a[9],  b[9])
+    g7,  p7  = GeneratePropagate(a[8],  b[8])
+    g8,  p8  = GeneratePropagate(a[7],  b[7])
+    g9,  p9  = GeneratePropagate(a[6],  b[6])
+    g10, p10 = GeneratePropagate(a[5],  b[5])
+    g11, p11 = GeneratePropagate(a[4],  b[4])
+    g12, p12 = GeneratePropagate(a[3],  b[3])
+    g13, p13 = GeneratePropagate(a[2],  b[2])
+    g14, p14 = GeneratePropagate(a[1],  b[1])
+    g15, p15 = GeneratePropagate(a[0],  b[0])
+
+    # Second level: treat each group of four lanes as a single
+    # lane and look ahead across the groups
+    gg0, pg0 = GroupGeneratePropagate4(g0,  p0,  g1,  p1,  g2,  p2,  g3,  p3)
+    gg1, pg1 = GroupGeneratePropagate4(g4,  p4,  g5,  p5,  g6,  p6,  g7,  p7)
+    gg2, pg2 = GroupGeneratePropagate4(g8,  p8,  g9,  p9,  g10, p10, g11, p11)
+
+    c4, c8, c12 = LookaheadCarry4(gg0, pg0, gg1, pg1, gg2, pg2, 0)
+
+    # First level: carries within each group
+    c1,  c2,  c3  = LookaheadCarry4(g0,  p0,  g1,  p1,  g2,  p2,  0)
+    c5,  c6,  c7  = LookaheadCarry4(g4,  p4,  g5,  p5,  g6,  p6,  c4)
+    c9,  c10, c11 = LookaheadCarry4(g8,  p8,  g9,  p9,  g10, p10, c8)
+    c13, c14, c15 = LookaheadCarry4(g12, p12, g13, p13, g14, p14, c12)
+
+    sm0  = p0
+    sm1  = Xor(p1,  c1)
+    sm2  = Xor(p2,  c2)
+    sm3  = Xor(p3,  c3)
+    sm4  = Xor(p4,  c4)
+    sm5  = Xor(p5,  c5)
+    sm6  = Xor(p6,  c6)
+    sm7  = Xor(p7,  c7)
+    sm8  = Xor(p8,  c8)
+    sm9  = Xor(p9,  c9)
+    sm10 = Xor(p10, c10)
+    sm11 = Xor(p11, c11)
+    sm12 = Xor(p12, c12)
+    sm13 = Xor(p13, c13)
+    sm14 = Xor(p14, c14)
+    sm15 = Xor(p15, c15)
+
+    return sm15, sm14, sm13, sm12, sm11, sm10, sm9, sm8, \
+           sm7,  sm6,  sm5,  sm4,  sm3,  sm2,  sm1, sm0
+
+def RippleAdd4(a, b, c):
+    sm0, cr0 = FullAdder(a[3], b[3], c)
+    sm1, cr1 = FullAdder(a[2], b[2], cr0)
+    sm2, cr2 = FullAdder(a[1], b[1], cr1)
+    sm3, cr3 = FullAdder(a[0], b[0], cr2)
+    return (sm3, sm2, sm1, sm0), cr3
+
+def CarrySelectAdd16(a, b):
+    # Each group of four lanes above the lowest is added twice,
+    # once assuming no carry comes in and once assuming one
+    # does, and the carry out of the group below selects the
+    # right result. Only the selection ripples between groups.
+    a0, b0 = (a[12], a[13], a[14], a[15]), (b[12], b[13], b[14], b[15])
+    a1, b1 = (a[8],  a[9],  a[10], a[11]), (b[8],  b[9],  b[10], b[11])
+    a2, b2 = (a[4],  a[5],  a[6],  a[7]),  (b[4],  b[5],  b[6],  b[7])
+    a3, b3 = (a[0],  a[1],  a[2],  a[3]),  (b[0],  b[1],  b[2],  b[3])
+
+    sm_0, cr_0 = RippleAdd4(a0, b0, 0)
+
+    sm_1_if0, cr_1_if0 = RippleAdd4(a1, b1, 0)
+    sm_1_if1, cr_1_if1 = RippleAdd4(a1, b1, 1)
+    sm_1 = Mux4(sm_1_if0, sm_1_if1, cr_0)
+    cr_1 = Mux(cr_1_if0, cr_1_if1, cr_0)
+
+    sm_2_if0, cr_2_if0 = RippleAdd4(a2, b2, 0)
+    sm_2_if1, cr_2_if1 = RippleAdd4(a2, b2, 1)
+    sm_2 = Mux4(sm_2_if0, sm_2_if1, cr_1)
+    cr_2 = Mux(cr_2_if0, cr_2_if1, cr_1)
+
+    sm_3_if0, _ = RippleAdd4(a3, b3, 0)
+    sm_3_if1, _ = RippleAdd4(a3, b3, 1)
+    sm_3 = Mux4(sm_3_if0, sm_3_if1, cr_2)
+
+    return sm_3[0], sm_3[1], sm_3[2], sm_3[3], \
+           sm_2[0], sm_2[1], sm_2[2], sm_2[3], \
+           sm_1[0], sm_1[1], sm_1[2], sm_1[3], \
+           sm_0[0], sm_0[1], sm_0[2], sm_0[3]
+
+def BlackCell(g_hi, p_hi, g_lo, p_lo):
+    # Combine a span of lanes with the span just below it
+    g = Or(g_hi, And(p_hi, g_lo))
+    p = And(p_hi, p_lo)
+    return g, p
+
+def GrayCell(g_hi, p_hi, g_lo):
+    # A BlackCell whose span already reaches lane 0, where
+    # only the generate output is ever needed
+    return Or(g_hi, And(p_hi, g_lo))
+
+def KoggeStoneAdd16(a, b):
+    # A parallel prefix adder. Level 0 is each lane's own
+    # generate/propagate pair; levels 1-4 combine every lane
+    # with the span 1, 2, 4 and then 8 lanes below it, so
+    # after four levels each lane knows whether a carry
+    # leaves it from anywhere below.
+    g0_0, p0_0 = GeneratePropagate(a[15], b[15])
+    g0_1, p0_1 = GeneratePropagate(a[14], b[14])
+    g0_2, p0_2 = GeneratePropagate(a[13], b[13])
+    g0_3, p0_3 = GeneratePropagate(a[12], b[12])
+    g0_4, p0_4 = GeneratePropagate(a[11], b[11])
+    g0_5, p0_5 = GeneratePropagate(a[10], b[10])
+    g0_6, p0_6 = GeneratePropagate(a[9], b[9])
+    g0_7, p0_7 = GeneratePropagate(a[8], b[8])
+    g0_8, p0_8 = GeneratePropagate(a[7], b[7])
+    g0_9, p0_9 = GeneratePropagate(a[6], b[6])
+    g0_10, p0_10 = GeneratePropagate(a[5], b[5])
+    g0_11, p0_11 = GeneratePropagate(a[4], b[4])
+    g0_12, p0_12 = GeneratePropagate(a[3], b[3])
+    g0_13, p0_13 = GeneratePropagate(a[2], b[2])
+    g0_14, p0_14 = GeneratePropagate(a[1], b[1])
+    g0_15, p0_15 = GeneratePropagate(a[0], b[0])
+
+    g1_1 = GrayCell(g0_1, p0_1, g0_0)
+    g1_2, p1_2 = BlackCell(g0_2, p0_2, g0_1, p0_1)
+    g1_3, p1_3 = BlackCell(g0_3, p0_3, g0_2, p0_2)
+    g1_4, p1_4 = BlackCell(g0_4, p0_4, g0_3, p0_3)
+    g1_5, p1_5 = BlackCell(g0_5, p0_5, g0_4, p0_4)
+    g1_6, p1_6 = BlackCell(g0_6, p0_6, g0_5, p0_5)
+    g1_7, p1_7 = BlackCell(g0_7, p0_7, g0_6, p0_6)
+    g1_8, p1_8 = BlackCell(g0_8, p0_8, g0_7, p0_7)
+    g1_9, p1_9 = BlackCell(g0_9, p0_9, g0_8, p0_8)
+    g1_10, p1_10 = BlackCell(g0_10, p0_10, g0_9, p0_9)
+    g1_11, p1_11 = BlackCell(g0_11, p0_11, g0_10, p0_10)
+    g1_12, p1_12 = BlackCell(g0_12, p0_12, g0_11, p0_11)
+    g1_13, p1_13 = BlackCell(g0_13, p0_13, g0_12, p0_12)
+    g1_14, p1_14 = BlackCell(g0_14, p0_14, g0_13, p0_13)
+    g1_15, p1_15 = BlackCell(g0_15, p0_15, g0_14, p0_14)
+
+    g2_2 = GrayCell(g1_2, p1_2, g0_0)
+    g2_3 = GrayCell(g1_3, p1_3, g1_1)
+    g2_4, p2_4 = BlackCell(g1_4, p1_4, g1_2, p1_2)
+    g2_5, p2_5 = BlackCell(g1_5, p1_5, g1_3, p1_3)
+    g2_6, p2_6 = BlackCell(g1_6, p1_6, g1_4, p1_4)
+    g2_7, p2_7 = BlackCell(g1_7, p1_7, g1_5, p1_5)
+    g2_8, p2_8 = BlackCell(g1_8, p1_8, g1_6, p1_6)
+    g2_9, p2_9 = BlackCell(g1_9, p1_9, g1_7, p1_7)
+    g2_10, p2_10 = BlackCell(g1_10, p1_10, g1_8, p1_8)
+    g2_11, p2_11 = BlackCell(g1_11, p1_11, g1_9, p1_9)
+    g2_12, p2_12 = BlackCell(g1_12, p1_12, g1_10, p1_10)
+    g2_13, p2_13 = BlackCell(g1_13, p1_13, g1_11, p1_11)
+    g2_14, p2_14 = BlackCell(g1_14, p1_14, g1_12, p1_12)
+    g2_15, p2_15 = BlackCell(g1_15, p1_15, g1_13, p1_13)
+
+    g3_4 = GrayCell(g2_4, p2_4, g0_0)
+    g3_5 = GrayCell(g2_5, p2_5, g1_1)
+    g3_6 = GrayCell(g2_6, p2_6, g2_2)
+    g3_7 = GrayCell(g2_7, p2_7, g2_3)
+    g3_8, p3_8 = BlackCell(g2_8, p2_8, g2_4, p2_4)
+    g3_9, p3_9 = BlackCell(g2_9, p2_9, g2_5, p2_5)
+    g3_10, p3_10 = BlackCell(g2_10, p2_10, g2_6, p2_6)
+    g3_11, p3_11 = BlackCell(g2_11, p2_11, g2_7, p2_7)
+    g3_12, p3_12 = BlackCell(g2_12, p2_12, g2_8, p2_8)
+    g3_13, p3_13 = BlackCell(g2_13, p2_13, g2_9, p2_9)
+    g3_14, p3_14 = BlackCell(g2_14, p2_14, g2_10, p2_10)
+    g3_15, p3_15 = BlackCell(g2_15, p2_15, g2_11, p2_11)
+
+    g4_8 = GrayCell(g3_8, p3_8, g0_0)
+    g4_9 = GrayCell(g3_9, p3_9, g1_1)
+    g4_10 = GrayCell(g3_10, p3_10, g2_2)
+    g4_11 = GrayCell(g3_11, p3_11, g2_3)
+    g4_12 = GrayCell(g3_12, p3_12, g3_4)
+    g4_13 = GrayCell(g3_13, p3_13, g3_5)
+    g4_14 = GrayCell(g3_14, p3_14, g3_6)
+    g4_15 = GrayCell(g3_15, p3_15, g3_7)  # carry out, unused
+
+    sm0 = p0_0
+    sm1 = Xor(p0_1, g0_0)
+    sm2 = Xor(p0_2, g1_1)
+    sm3 = Xor(p0_3, g2_2)
+    sm4 = Xor(p0_4, g2_3)
+    sm5 = Xor(p0_5, g3_4)
+    sm6 = Xor(p0_6, g3_5)
+    sm7 = Xor(p0_7, g3_6)
+    sm8 = Xor(p0_8, g3_7)
+    sm9 = Xor(p0_9, g4_8)
+    sm10 = Xor(p0_10, g4_9)
+    sm11 = Xor(p0_11, g4_10)
+    sm12 = Xor(p0_12, g4_11)
+    sm13 = Xor(p0_13, g4_12)
+    sm14 = Xor(p0_14, g4_13)
+    sm15 = Xor(p0_15, g4_14)
+
+    return sm15, sm14, sm13, sm12, sm11, sm10, sm9, sm8, \
+           sm7,  sm6,  sm5,  sm4,  sm3,  sm2,  sm1, sm0
+
+
+def ALU(x, y, zx, nx, zy, ny, f, no, adder=Add16):
     zero16 = (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
 
     mid_x = Mux16(x, zero16, zx)
@@ -49,7 +293,7 @@ def ALU(x, y, zx, nx, zy, ny, f, no):
     end_y = Mux16(mid_y, Not16(mid_y), ny)
 
     mid_out = Mux16(And16(end_x, end_y),
-                    Add16(end_x, end_y),
+                    adder(end_x, end_y),
                     f)
 
     out = Mux16(mid_out, Not16(mid_out), no)
@@ -62,3 +306,59 @@ def ALU(x, y, zx, nx, zy, ny, f, no):
     ng = out[0]
 
     return out, zr, ng
+
+
+##########################################################
+# Word-mode versions of the arithmetic chips, built on the
+# word-mode gates in logic.py. Buses are ints in 0..0xFFFF
+# rather than tuples of bits.
+##########################################################
+
+def Add16Word(a, b):
+    # A ripple carry would need sixteen rounds of lane-wide
+    # gates, so instead the carries are found with a parallel
+    # prefix over the generate/propagate lanes: after the
+    # round with shift s, lane i knows whether a carry leaves
+    # it from anywhere in the 2*s lanes ending at i. Shifting
+    # a word up by s lanes is wiring; lanes shifted in from
+    # below lane 0 are tied to 0, i.e. there is no carry in.
+    half_sum = Xor16Word(a, b)
+    gen  = And16Word(a, b)
+    prop = half_sum
+
+    gen  = Or16Word(gen, And16Word(prop, (gen << 1) & 0xFFFF))
+    prop = And16Word(prop, (prop << 1) & 0xFFFF)
+    gen  = Or16Word(gen, And16Word(prop, (gen << 2) & 0xFFFF))
+    prop = And16Word(prop, (prop << 2) & 0xFFFF)
+    gen  = Or16Word(gen, And16Word(prop, (gen << 4) & 0xFFFF))
+    prop = And16Word(prop, (prop << 4) & 0xFFFF)
+    gen  = Or16Word(gen, And16Word(prop, (gen << 8) & 0xFFFF))
+
+    carry_in = (gen << 1) & 0xFFFF
+    return Xor16Word(half_sum, carry_in)
+
+def Inc16Word(inp):
+    return Add16Word(inp, 1)
+
+def ALUWord(x, y, zx, nx, zy, ny, f, no):
+    zero16 = 0
+
+    mid_x = Mux16Word(x, zero16, zx)
+
+    end_x = Mux16Word(mid_x, Not16Word(mid_x), nx)
+
+    mid_y = Mux16Word(y, zero16, zy)
+
+    end_y = Mux16Word(mid_y, Not16Word(mid_y), ny)
+
+    mid_out = Mux16Word(And16Word(end_x, end_y),
+                        Add16Word(end_x, end_y),
+                        f)
+
+    out = Mux16Word(mid_out, Not16Word(mid_out), no)
+
+    zr = Not(Or16WayWord(out))
+
+    ng = out >> 15
+
+    return out, zr, ng
@@ -1,3 +1,11 @@
+import argparse
+import glob
+import itertools
+import struct
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from pathlib import Path
 
@@ -9,26 +17,45 @@ class InstructionType(Enum):
 
 
 class Parser:
+    # The file is read as a stream, one line at a time, and
+    # the parser always holds the next instruction in
+    # self.next_instruction so that has_more_lines is exact
+    # even when the file ends in blank or comment lines. Use
+    # it in a with block so the file is closed even if
+    # assembly stops part way through.
     def __init__(self, asm_path):
-        with open(asm_path, 'r') as f:
-            self.lines = f.readlines()
-
+        self.file = open(asm_path, 'r')
         self.current_instruction = None
-    
+        self.next_instruction = self._read_instruction()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _read_instruction(self):
+        for line in self.file:
+            # Remove any comment and all whitespace, so that
+            # "D=M // x" and "D = M" both give "D=M"
+            line = ''.join(line.split('//', 1)[0].split())
+            if line:
+                return line
+        return None
+
     @property
     def has_more_lines(self):
-        return len(self.lines) > 0
-    
+        return self.next_instruction is not None
+
     def advance(self):
-        while True:
-            if len(self.lines) == 0:
-                return
-            
-            line = self.lines.pop(0).strip()
-            if line != '' and not line.startswith('//'):
-                # Remove any trailing comments
-                self.current_instruction = line.split()[0]
-                break
+        if self.next_instruction is None:
+            return
+
+        self.current_instruction = self.next_instruction
+        self.next_instruction = self._read_instruction()
     
     @property
     def instruction_type(self):
@@ -79,54 +106,97 @@ class Parser:
         return self.current_instruction.split(';')[1]
 
 
-class Code:
-    def dest(s):
-        if s is None:
-            return '000'
+##########################################################
+# Encoding tables
+#
+# Every legal comp, dest and jump mnemonic mapped straight
+# to its bit field within the 16-bit C-instruction, so that
+# encoding an instruction is three dict lookups and an OR:
+#
+#   0xE000 | COMP_BITS[comp] | DEST_BITS[dest] | JUMP_BITS[jump]
+#
+# The tables also accept the other operand order of the
+# commutative computations (M+D as well as D+M, A&D as well
+# as D&A) and the destinations in any order (MD or DM).
+##########################################################
+
+# The a bit and six control bits of each computation, with
+# y = A (or M when the a bit is set)
+_COMPUTATIONS = {
+    '0':   0b101010,
+    '1':   0b111111,
+    '-1':  0b111010,
+    'D':   0b001100,
+    'y':   0b110000,
+    '!D':  0b001101,
+    '!y':  0b110001,
+    '-D':  0b001111,
+    '-y':  0b110011,
+    'D+1': 0b011111,
+    'y+1': 0b110111,
+    'D-1': 0b001110,
+    'y-1': 0b110010,
+    'D+y': 0b000010,
+    'D-y': 0b010011,
+    'y-D': 0b000111,
+    'D&y': 0b000000,
+    'D|y': 0b010101,
+}
+
+def _comp_bits():
+    table = {}
+    for mnemonic, control in _COMPUTATIONS.items():
+        for register, a_bit in (('A', 0), ('M', 1)):
+            if 'y' not in mnemonic and a_bit:
+                continue
+            bits = (a_bit << 12) | (control << 6)
+            variant = mnemonic.replace('y', register)
+            table[variant] = bits
+            for op in '+&|':
+                if op in variant:
+                    left, right = variant.split(op)
+                    table[right + op + left] = bits
+    return table
+
+COMP_BITS = _comp_bits()
+
+def _dest_bits():
+    table = {None: 0}
+    for n in range(1, 4):
+        for registers in itertools.permutations('ADM', n):
+            bits = (('A' in registers) << 2 | ('D' in registers) << 1 |
+                    ('M' in registers))
+            table[''.join(registers)] = bits << 3
+    return table
 
-        a_bit = '1' if 'A' in s else '0'
-        d_bit = '1' if 'D' in s else '0'
-        m_bit = '1' if 'M' in s else '0'
+DEST_BITS = _dest_bits()
 
-        return a_bit + d_bit + m_bit
+JUMP_BITS = {
+    None:  0b000,
+    'JGT': 0b001,
+    'JEQ': 0b010,
+    'JGE': 0b011,
+    'JLT': 0b100,
+    'JNE': 0b101,
+    'JLE': 0b110,
+    'JMP': 0b111,
+}
+
+
+class Code:
+    # Binary strings for each field, as in the book's API;
+    # the assembler itself uses the tables above directly
+    def dest(s):
+        return f'{DEST_BITS[s] >> 3:03b}'
     
     def comp(s):
-        r, a = ('M', '1') if 'M' in s else ('A', '0')
-        comp2binary = {
-            '0':    '101010',
-            '1':    '111111',
-            '-1':   '111010',
-            'D':    '001100',
-            r:      '110000',
-            '!D':   '001101',
-            '!'+r:  '110001',
-            '-D':   '001111',
-            '-'+r:  '110011',
-            'D+1':  '011111',
-            r+'+1': '110111',
-            'D-1':  '001110',
-            r+'-1': '110010',
-            'D+'+r: '000010',
-            'D-'+r: '010011',
-            r+'-D': '000111',
-            'D&'+r: '000000',
-            'D|'+r: '010101', 
-        }
-
-        cccccc = comp2binary[s]
-        return a + cccccc
+        return f'{COMP_BITS[s] >> 6:07b}'
 
     def jump(s):
-        return {
-            None:  '000',
-            'JGT': '001',
-            'JEQ': '010',
-            'JGE': '011',
-            'JLT': '100',
-            'JNE': '101',
-            'JLE': '110',
-            'JMP': '111'
-        }[s]
+        return f'{JUMP_BITS[s]:03b}'
+
+    def encode(dest, comp, jump):
+        return 0xE000 | COMP_BITS[comp] | DEST_BITS[dest] | JUMP_BITS[jump]
 
 
 class SymbolTable(dict):
@@ -144,53 +214,243 @@ class SymbolTable(dict):
         self['KBD'] = 24576
 
 
+class Instruction:
+    # One A- or C-instruction from the first pass. C-instructions
+    # and numeric A-instructions are encoded straight away into
+    # their 16-bit word; symbolic A-instructions keep their
+    # symbol, which is only resolved in the second pass once
+    # every label is known.
+    __slots__ = ('symbol', 'code')
+
+    def __init__(self, symbol=None, code=None):
+        self.symbol = symbol
+        self.code = code
+
+
+##########################################################
+# Output formats
+#
+# Besides the book's text format (one line of 16 '0'/'1'
+# characters per instruction, in a .hack file), a program
+# can be kept in memory as an array('H') of instruction
+# words or written in a packed binary format (.hackbin):
+#
+#   magic   4 bytes  b'HACK'
+#   version uint16   BINARY_VERSION
+#   count   uint32   number of instruction words
+#   words   count x uint16
+#
+# with every integer little-endian.
+##########################################################
+
+BINARY_MAGIC = b'HACK'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHI')
+
+
+def pack(words):
+    words = array('H', words)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(words)) + \
+           words.tobytes()
+
+def unpack(data):
+    magic, version, count = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f'not a version {BINARY_VERSION} Hack binary')
+
+    body = data[BINARY_HEADER.size:BINARY_HEADER.size + 2 * count]
+    if len(body) != 2 * count:
+        raise ValueError(f'Hack binary is truncated: expected {count} '
+                         f'words, found {len(body) / 2:g}')
+
+    words = array('H')
+    words.frombytes(body)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+def to_text(words):
+    return ''.join(f'{word:016b}\n' for word in words)
+
+
 class HackAssembler:
     def __init__(self):
         self.symbol_table = SymbolTable()
+        self.timings = {}
     
-    def translate(self, asm_path):
-        self._first_pass(asm_path)
-        self._second_pass(asm_path)
+    def assemble(self, asm_path):
+        # The program as an array of instruction words. Each
+        # program gets a fresh symbol table, so labels and
+        # variables from an earlier program don't leak into it.
+        self.symbol_table = SymbolTable()
+        start = time.perf_counter()
+        instructions = self._first_pass(asm_path)
+        self.timings['first pass'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        words = self._second_pass(instructions)
+        self.timings['second pass'] = time.perf_counter() - start
+        return words
+
+    def translate(self, asm_path, binary=False):
+        # Write the program next to the source, as a .hack text
+        # file or with binary=True as a packed .hackbin file,
+        # and return the path written
+        words = self.assemble(asm_path)
+
+        start = time.perf_counter()
+        if binary:
+            out_path = Path(asm_path).with_suffix('.hackbin')
+            with open(out_path, 'wb') as f:
+                f.write(pack(words))
+        else:
+            out_path = Path(asm_path).with_suffix('.hack')
+            with open(out_path, 'w') as f:
+                f.write(to_text(words))
+        self.timings['output'] = time.perf_counter() - start
+        return out_path
     
     def _first_pass(self, asm_path):
-        line_number = 0
-        parser = Parser(asm_path)
-        while parser.has_more_lines:
-            parser.advance()
-
-            if parser.instruction_type == InstructionType.L_INSTRUCTION:
-                self.symbol_table[parser.symbol] = line_number
-            else:
-                line_number += 1
-    
-    def _second_pass(self, asm_path):
-        next_available_address = 16
-        hack_path = Path(asm_path).with_suffix('.hack')
-        with open(hack_path, 'w') as f:
-            parser = Parser(asm_path)
+        # Read and parse the file once, recording label
+        # addresses and the instructions to encode
+        instructions = []
+        with Parser(asm_path) as parser:
             while parser.has_more_lines:
                 parser.advance()
 
-                if parser.instruction_type == InstructionType.C_INSTRUCTION:
-                    acccccc = Code.comp(parser.comp)
-                    ddd = Code.dest(parser.dest)
-                    jjj = Code.jump(parser.jump)
-                    f.write(f'111{acccccc}{ddd}{jjj}\n')
-                elif parser.instruction_type == InstructionType.A_INSTRUCTION:
-                    if not parser.symbol.isdigit():
-                        if not parser.symbol in self.symbol_table:
-                            self.symbol_table[parser.symbol] = next_available_address
-                            next_available_address += 1
-                        
-                        address = str(self.symbol_table[parser.symbol])
+                instruction_type = parser.instruction_type
+                if instruction_type == InstructionType.L_INSTRUCTION:
+                    self.symbol_table[parser.symbol] = len(instructions)
+                elif instruction_type == InstructionType.A_INSTRUCTION:
+                    if parser.symbol.isdigit():
+                        code = int(parser.symbol)
+                        if code > 0x7FFF:
+                            raise ValueError(f'@{parser.symbol} at ROM '
+                                             f'address {len(instructions)} '
+                                             f'does not fit in an '
+                                             f'A-instruction')
+                        instructions.append(Instruction(code=code))
                     else:
-                        address = parser.symbol
-                    
-                    f.write('0' + f'{int(address):015b}\n')
-                else: # L-instructions were processed in the first pass
-                    continue
-                
+                        instructions.append(Instruction(symbol=parser.symbol))
+                else:
+                    try:
+                        code = Code.encode(parser.dest, parser.comp,
+                                           parser.jump)
+                    except KeyError:
+                        raise ValueError(f'invalid instruction '
+                                         f'{parser.current_instruction!r} at '
+                                         f'ROM address {len(instructions)}')
+                    instructions.append(Instruction(code=code))
 
-if __name__ == '__main__':
+        return instructions
+    
+    def _second_pass(self, instructions):
+        next_available_address = 16
+        words = array('H', bytes(2 * len(instructions)))
+        for i, instruction in enumerate(instructions):
+            if instruction.code is None:
+                symbol = instruction.symbol
+                if not symbol in self.symbol_table:
+                    self.symbol_table[symbol] = next_available_address
+                    next_available_address += 1
+
+                instruction.code = self.symbol_table[symbol]
+                if instruction.code > 0x7FFF:
+                    raise ValueError(f'{symbol} resolves to {instruction.code}'
+                                     f', which does not fit in an '
+                                     f'A-instruction')
+            words[i] = instruction.code
+
+        return words
+
+
+##########################################################
+# Batch assembly
+#
+# assemble_all assembles many files at once, each in a
+# worker process with its own HackAssembler (and so its own
+# SymbolTable). A file that fails to assemble is reported
+# with its error rather than stopping the batch.
+##########################################################
+
+class BatchResult:
+    __slots__ = ('asm_path', 'out_path', 'seconds', 'timings', 'error')
+
+    def __init__(self, asm_path, out_path=None, seconds=0.0, timings=None,
+                 error=None):
+        # timings are the per-pass HackAssembler.timings, as far
+        # as the file got
+        self.asm_path = asm_path
+        self.out_path = out_path
+        self.seconds = seconds
+        self.timings = timings or {}
+        self.error = error
+
+
+def find_asm_files(inputs):
+    # Each input is a directory (all the .asm files in it), a
+    # glob pattern or a plain path
+    paths = []
+    for inp in inputs:
+        if Path(inp).is_dir():
+            paths.extend(sorted(Path(inp).glob('*.asm')))
+        elif glob.has_magic(inp):
+            paths.extend(sorted(Path(p) for p in glob.glob(inp)))
+        else:
+            paths.append(Path(inp))
+    return paths
+
+
+def _assemble_file(asm_path, binary):
+    start = time.perf_counter()
     assembler = HackAssembler()
-    assembler.translate('testfiles/Test.asm')
\ No newline at end of file
+    try:
+        out_path = assembler.translate(asm_path, binary=binary)
+    except Exception as e:
+        return BatchResult(asm_path, seconds=time.perf_counter() - start,
+                           timings=assembler.timings,
+                           error=f'{type(e).__name__}: {e}')
+    return BatchResult(asm_path, out_path, time.perf_counter() - start,
+                       assembler.timings)
+
+
+def assemble_all(inputs, jobs=None, binary=False):
+    # Returns a BatchResult per file, in the order of
+    # find_asm_files. jobs is the number of worker processes,
+    # defaulting to one per core; jobs=1 assembles everything
+    # in this process.
+    paths = find_asm_files(inputs)
+    binaries = [binary] * len(paths)
+    if jobs == 1:
+        return list(map(_assemble_file, paths, binaries))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_assemble_file, paths, binaries))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Assemble Hack .asm files into .hack machine code.')
+    parser.add_argument('inputs', nargs='+',
+                        help='.asm files, directories or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--binary', action='store_true',
+                        help='write packed .hackbin files instead of .hack')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = assemble_all(args.inputs, args.jobs, args.binary)
+    for result in results:
+        status = f'error: {result.error}' if result.error \
+                 else f'-> {result.out_path}'
+        print(f'{result.seconds:8.3f}s  {result.asm_path} {status}')
+        for name, seconds in result.timings.items():
+            print(f'{"":11}{name}: {seconds:.3f}s')
+
+    failed = sum(1 for result in results if result.error)
+    print(f'{len(results)} files, {failed} failed, '
+          f'{time.perf_counter() - start:.3f}s')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,276 @@
+import numpy as np
+
+
+##########################################################
+# Batched versions of the combinational chips in logic.py
+# and arithmetic.py, evaluated with NumPy over many input
+# vectors at once.
+#
+# A single-bit input is an array of 0/1 values with one
+# entry per input vector, shape (N,). A 16-bit bus can be
+# given either as an (N, 16) array of 0/1 values, ordered
+# like the tuple buses (column 0 is the most significant
+# bit), or packed as an (N,) uint16 array where each entry
+# is one bus in the word layout of the word-mode gates.
+# Buses are always packed on the way in and every chip
+# returns packed uint16 buses; unpack turns them back into
+# (N, 16) bits. Multi-bit selectors are given as a tuple
+# of (N,) arrays like the sel tuples in logic.py, or as an
+# (N, k) array of bits with the same column order.
+#
+# As in logic.py, Nand (and its sixteen-lane twin Nand16)
+# is the only primitive and everything else is wired up
+# from previously-defined chips. Each gate call is a few
+# NumPy operations over all N vectors, so the Python call
+# overhead is paid once per gate rather than once per gate
+# per input.
+##########################################################
+
+def pack(bits):
+    bits = np.asarray(bits, dtype=np.uint8)
+    packed = np.packbits(bits, axis=-1, bitorder='big')
+    return packed.view('>u2')[..., 0].astype(np.uint16)
+
+def unpack(words):
+    words = np.asarray(words, dtype='>u2')
+    return np.unpackbits(words[..., None].view(np.uint8), axis=-1,
+                         bitorder='big')
+
+def _bus(bus):
+    # Told apart by shape rather than dtype, since bits may
+    # come in any integer dtype, uint16 included
+    bus = np.asarray(bus)
+    if bus.ndim == 2 and bus.shape[-1] == 16:
+        return pack(bus)
+    if bus.ndim == 1:
+        return bus.astype(np.uint16, copy=False)
+    raise ValueError(f'a bus must be (N,) packed words or (N, 16) bits, '
+                     f'not shape {bus.shape}')
+
+def _bit(bit):
+    return np.asarray(bit, dtype=np.uint8)
+
+def _sel(sel):
+    if isinstance(sel, np.ndarray) and sel.ndim == 2:
+        return tuple(_bit(sel[:, i]) for i in range(sel.shape[1]))
+    return tuple(_bit(s) for s in sel)
+
+
+##########################################################
+# Single-bit gates
+##########################################################
+
+def Nand(a, b):
+    return 1 ^ (_bit(a) & _bit(b))
+
+def Not(a):
+    return Nand(a, a)
+
+def And(a, b):
+    return Not(Nand(a, b))
+
+def Or(a, b):
+    return Nand(Not(a), Not(b))
+
+def Xor(a, b):
+    return Or(And(a, Not(b)),
+              And(Not(a), b))
+
+def Mux(a, b, sel):
+    return Or(And(Not(sel), a),
+              And(sel, b))
+
+def DMux(inp, sel):
+    a = And(Xor(inp, sel),
+            Not(sel))
+    b = And(inp, sel)
+    return a, b
+
+
+##########################################################
+# 16-bit gates on packed buses
+##########################################################
+
+def Fanout16(bit):
+    # Wire a single bit to all sixteen lanes
+    return _bit(bit).astype(np.uint16) * np.uint16(0xFFFF)
+
+def Nand16(a, b):
+    return ~(_bus(a) & _bus(b))
+
+def Not16(inp):
+    return Nand16(inp, inp)
+
+def And16(a, b):
+    return Not16(Nand16(a, b))
+
+def Or16(a, b):
+    return Nand16(Not16(a), Not16(b))
+
+def Xor16(a, b):
+    nand_ab = Nand16(a, b)
+    return Nand16(Nand16(a, nand_ab),
+                  Nand16(b, nand_ab))
+
+def Mux16(a, b, sel):
+    sel16 = Fanout16(sel)
+    return Nand16(Nand16(Not16(sel16), a),
+                  Nand16(sel16, b))
+
+
+##########################################################
+# Multi-way gates
+##########################################################
+
+def Or8Way(inp):
+    inp = _sel(inp)
+    return Or(inp[7],
+              Or(inp[6],
+                 Or(inp[5],
+                    Or(inp[4],
+                       Or(inp[3],
+                          Or(inp[2],
+                             Or(inp[1],
+                                inp[0])))))))
+
+def Or16Way(inp):
+    inp = _bus(inp)
+    half  = Or16(inp, inp >> 8)
+    quart = Or16(half, half >> 4)
+    pair  = Or16(quart, quart >> 2)
+    out   = Or16(pair, pair >> 1)
+    return (out & 1).astype(np.uint8)
+
+def Mux4Way16(a, b, c, d, sel):
+    sel = _sel(sel)
+    sel0 = sel[1]
+    sel1 = sel[0]
+
+    a_or_b = Mux16(a, b, sel0)
+    c_or_d = Mux16(c, d, sel0)
+
+    return Mux16(a_or_b, c_or_d, sel1)
+
+def Mux8Way16(a, b, c, d, e, f, g, h, sel):
+    sel = _sel(sel)
+    sel0 = sel[2]
+    sel1 = sel[1]
+    sel2 = sel[0]
+
+    a_or_b = Mux16(a, b, sel0)
+    c_or_d = Mux16(c, d, sel0)
+    e_or_f = Mux16(e, f, sel0)
+    g_or_h = Mux16(g, h, sel0)
+
+    abc_or_d = Mux16(a_or_b, c_or_d, sel1)
+    efg_or_h = Mux16(e_or_f, g_or_h, sel1)
+
+    return Mux16(abc_or_d, efg_or_h, sel2)
+
+def DMux4Way(inp, sel):
+    sel = _sel(sel)
+    sel0 = sel[1]
+    sel1 = sel[0]
+
+    y, z = DMux(inp, sel0)
+
+    a = And(Not(sel1), y)
+    b = And(Not(sel1), z)
+    c = And(sel1, y)
+    d = And(sel1, z)
+
+    return a, b, c, d
+
+def DMux8Way(inp, sel):
+    sel = _sel(sel)
+    sel0 = sel[2]
+    sel1 = sel[1]
+    sel2 = sel[0]
+
+    w, x, y, z = DMux4Way(inp, (sel1, sel0))
+
+    a = And(Not(sel2), w)
+    b = And(Not(sel2), x)
+    c = And(Not(sel2), y)
+    d = And(Not(sel2), z)
+    e = And(sel2, w)
+    f = And(sel2, x)
+    g = And(sel2, y)
+    h = And(sel2, z)
+
+    return a, b, c, d, e, f, g, h
+
+
+##########################################################
+# Arithmetic chips
+##########################################################
+
+def HalfAdder(a, b):
+    sm = Xor(a, b)
+    cr = And(a, b)
+    return sm, cr
+
+def FullAdder(a, b, c):
+    s0, c0 = HalfAdder(a, b)
+    sm, c1 = HalfAdder(s0, c)
+    cr = Or(c0, c1)
+    return sm, cr
+
+def Add16(a, b):
+    # Same parallel-prefix carry as arithmetic.Add16Word;
+    # shifting a uint16 array drops the carry out of lane 15.
+    half_sum = Xor16(a, b)
+    gen  = And16(a, b)
+    prop = half_sum
+
+    gen  = Or16(gen, And16(prop, gen << 1))
+    prop = And16(prop, prop << 1)
+    gen  = Or16(gen, And16(prop, gen << 2))
+    prop = And16(prop, prop << 2)
+    gen  = Or16(gen, And16(prop, gen << 4))
+    prop = And16(prop, prop << 4)
+    gen  = Or16(gen, And16(prop, gen << 8))
+
+    return Xor16(half_sum, gen << 1)
+
+def Inc16(inp):
+    return Add16(inp, np.ones_like(_bus(inp)))
+
+def ALU(x, y, zx, nx, zy, ny, f, no):
+    zero16 = np.zeros_like(_bus(x))
+
+    mid_x = Mux16(x, zero16, zx)
+
+    end_x = Mux16(mid_x, Not16(mid_x), nx)
+
+    mid_y = Mux16(y, zero16, zy)
+
+    end_y = Mux16(mid_y, Not16(mid_y), ny)
+
+    mid_out = Mux16(And16(end_x, end_y),
+                    Add16(end_x, end_y),
+                    f)
+
+    out = Mux16(mid_out, Not16(mid_out), no)
+
+    zr = Not(Or16Way(out))
+
+    ng = (out >> 15).astype(np.uint8)
+
+    return out, zr, ng
+
+
+if __name__ == '__main__':
+    import time
+
+    n = 1_000_000
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 1 << 16, n, dtype=np.uint16)
+    y = rng.integers(0, 1 << 16, n, dtype=np.uint16)
+    control = rng.integers(0, 2, (6, n), dtype=np.uint8)
+
+    start = time.perf_counter()
+    ALU(x, y, *control)
+    elapsed = time.perf_counter() - start
+    print(f'ALU: {n} vectors in {elapsed:.3f}s '
+          f'({n / elapsed:,.0f} vectors/s)')
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+
+import assembler
+import peephole
+import stackalloc
+import vm
+
+
+##########################################################
+# A content-addressed cache for build outputs
+#
+# Translating a .vm file or assembling an .asm file only
+# depends on the source's contents, the translator or
+# assembler itself and the options it was run with, plus,
+# for a .vm file, its name, which every static variable is
+# named after. The cache key is a SHA-256 over all of
+# these, the "version" of a tool being the hash of its own
+# source code, so editing vm.py or assembler.py
+# invalidates everything it built.
+#
+# Entries are plain files named by their key in the cache
+# directory. A hit copies the cached bytes to where the
+# tool would have written its output; a miss runs the tool
+# and stores what it wrote. Every hit touches the entry's
+# modification time, and whenever the directory grows past
+# max_bytes the least recently used entries are deleted.
+##########################################################
+
+DEFAULT_DIRECTORY = '.buildcache'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# The modules whose source makes up each tool
+TOOLS = {
+    'vm': [vm, peephole, stackalloc],
+    'assembler': [assembler],
+}
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def tool_version(tool):
+    digest = hashlib.sha256()
+    for module in TOOLS[tool]:
+        digest.update(_file_digest(module.__file__).encode())
+    return digest.hexdigest()
+
+
+class BuildCache:
+    def __init__(self, directory=DEFAULT_DIRECTORY,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._versions = {}
+
+    def key(self, source_path, tool, options):
+        if tool not in self._versions:
+            self._versions[tool] = tool_version(tool)
+        digest = hashlib.sha256()
+        digest.update(tool.encode())
+        digest.update(self._versions[tool].encode())
+        digest.update(json.dumps(options, sort_keys=True).encode())
+        if tool == 'vm':
+            digest.update(Path(source_path).stem.encode())
+        digest.update(_file_digest(source_path).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = self.directory / key
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.stats['misses'] += 1
+            return None
+
+        os.utime(path)
+        self.stats['hits'] += 1
+        return data
+
+    def put(self, key, data):
+        # Written under a temporary name and renamed, so that a
+        # concurrent reader never sees a partial entry
+        path = self.directory / key
+        tmp_path = path.with_name(f'{key}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.stats['stores'] += 1
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix == '.tmp':
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def build(self, source_path, output_path, tool, options, run):
+        # Produce output_path from source_path, calling run()
+        # to actually build it on a miss. Returns output_path.
+        key = self.key(source_path, tool, options)
+        data = self.get(key)
+        if data is None:
+            run()
+            with open(output_path, 'rb') as f:
+                self.put(key, f.read())
+        else:
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        return Path(output_path)
+
+    def translate_vm(self, vm_path, **options):
+        # One .vm file at a time; a directory is one program
+        # built from several sources, which a single key
+        # doesn't describe
+        if Path(vm_path).is_dir():
+            raise ValueError(f'{vm_path} is a directory; the build cache '
+                             f'translates single .vm files')
+        output_path = Path(vm_path).with_suffix('.asm')
+        return self.build(vm_path, output_path, 'vm', options,
+                          lambda: vm.VMTranslator(vm_path, **options))
+
+    def assemble(self, asm_path, binary=False):
+        suffix = '.hackbin' if binary else '.hack'
+        output_path = Path(asm_path).with_suffix(suffix)
+        return self.build(asm_path, output_path, 'assembler',
+                          {'binary': binary},
+                          lambda: assembler.HackAssembler().translate(
+                              asm_path, binary=binary))
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+
+if __name__ == '__main__':
+    # Build each .vm file to .asm and each .asm file to .hack
+    # through the cache
+    cache = BuildCache()
+    for source in sys.argv[1:]:
+        if source.endswith('.vm'):
+            print(cache.translate_vm(source))
+        else:
+            print(cache.assemble(source))
+    print(f'{cache.stats["hits"]} hits, {cache.stats["misses"]} misses, '
+          f'{cache.stats["evictions"]} evictions')
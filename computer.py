@@ -0,0 +1,254 @@
+import time
+
+from logic import *
+from arithmetic import ALU
+from memory import Register, PC, Lazy, RAM4K, RAM16K
+
+
+##########################################################
+# Finally we put the pieces together into the Hack
+# computer: a CPU built around the ALU, the A and D
+# registers and the PC, a data memory made of RAM16K plus
+# the memory-mapped screen and keyboard, and a ROM that
+# holds the program.
+#
+# Like the chips in memory.py, each eval call is one clock
+# cycle: the chip's outputs are computed from its current
+# state and its inputs, and then its registers are clocked.
+# Since we simulate one cycle at a time rather than letting
+# signals settle, the Computer reads the data memory (the
+# CPU's inM) before evaluating the CPU, and then clocks the
+# memory with the CPU's outM/writeM/addressM.
+#
+# Buses are tuples of bits as everywhere else, with index 0
+# the most significant bit, so instruction[0] is the bit
+# that tells A- and C-instructions apart.
+##########################################################
+
+def load_hack(hack_path):
+    with open(hack_path, 'r') as f:
+        return [tuple(map(int, line.strip())) for line in f if line.strip()]
+
+
+class ROM32K:
+    # The program is given to the computer from outside, so
+    # the ROM simply holds the instruction words. Addresses
+    # past the end of the program read as zero.
+    size = 32768
+
+    def __init__(self, program=()):
+        self.program = list(program)
+
+    def eval(self, addr):
+        index = bus_to_word(addr)
+        if index < len(self.program):
+            return self.program[index]
+        return (0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0)
+
+
+class Screen:
+    size = 8192
+
+    def __init__(self):
+        self.r0 = Lazy(RAM4K)
+        self.r1 = Lazy(RAM4K)
+
+    def eval(self, inp, load, addr):
+        msb_addr = addr[0]
+        lsb_addr = (addr[1], addr[2], addr[3],
+                    addr[4], addr[5], addr[6],
+                    addr[7], addr[8], addr[9],
+                    addr[10], addr[11], addr[12])
+
+        ld0, ld1 = DMux(load, msb_addr)
+
+        out0 = self.r0.eval(inp, ld0, lsb_addr)
+        out1 = self.r1.eval(inp, ld1, lsb_addr)
+
+        return Mux16(out0, out1, msb_addr)
+
+    def eval_decoded(self, inp, load, addr):
+        msb_addr = addr[0]
+        lsb_addr = (addr[1], addr[2], addr[3],
+                    addr[4], addr[5], addr[6],
+                    addr[7], addr[8], addr[9],
+                    addr[10], addr[11], addr[12])
+
+        ram = self.r1 if msb_addr else self.r0
+        return ram.eval_decoded(inp, load, lsb_addr)
+
+    def __str__(self):
+        return f'{self.r0}\n{self.r1}'
+
+    def __repr__(self):
+        return str(self)
+
+
+class Keyboard:
+    # The keyboard register is written by the outside world
+    # (press) and only ever read by the computer
+    def __init__(self):
+        self.reg = Register()
+
+    def press(self, key):
+        self.reg.eval(word_to_bus(key), load=1)
+
+    def eval(self):
+        return self.reg.val
+
+
+class Memory:
+    # The 32K data address space: RAM16K at 0-16383, the
+    # screen at 16384-24575 and the keyboard at 24576. The
+    # address is 15 bits wide.
+    def __init__(self):
+        self.ram = RAM16K()
+        self.screen = Screen()
+        self.keyboard = Keyboard()
+
+    def eval(self, inp, load, addr):
+        ram_addr = (addr[1], addr[2], addr[3], addr[4], addr[5],
+                    addr[6], addr[7], addr[8], addr[9], addr[10],
+                    addr[11], addr[12], addr[13], addr[14])
+        screen_addr = (addr[2], addr[3], addr[4], addr[5], addr[6],
+                       addr[7], addr[8], addr[9], addr[10], addr[11],
+                       addr[12], addr[13], addr[14])
+
+        load_ram, load_io = DMux(load, addr[0])
+        load_screen, _ = DMux(load_io, addr[1])
+
+        ram_out = self.ram.eval(inp, load_ram, ram_addr)
+        screen_out = self.screen.eval(inp, load_screen, screen_addr)
+        keyboard_out = self.keyboard.eval()
+
+        return Mux4Way16(ram_out, ram_out, screen_out, keyboard_out,
+                         sel=(addr[0], addr[1]))
+
+    def eval_decoded(self, inp, load, addr):
+        # See the notes on eval_decoded in memory.py: only the
+        # addressed device is evaluated
+        if not addr[0]:
+            ram_addr = (addr[1], addr[2], addr[3], addr[4], addr[5],
+                        addr[6], addr[7], addr[8], addr[9], addr[10],
+                        addr[11], addr[12], addr[13], addr[14])
+            return self.ram.eval_decoded(inp, load, ram_addr)
+        if not addr[1]:
+            screen_addr = (addr[2], addr[3], addr[4], addr[5], addr[6],
+                           addr[7], addr[8], addr[9], addr[10], addr[11],
+                           addr[12], addr[13], addr[14])
+            return self.screen.eval_decoded(inp, load, screen_addr)
+        return self.keyboard.eval()
+
+    def peek(self, address):
+        addr = word_to_bus(address)[1:]
+        return bus_to_word(self.eval_decoded(word_to_bus(0), 0, addr))
+
+    def poke(self, address, value):
+        addr = word_to_bus(address)[1:]
+        self.eval_decoded(word_to_bus(value), 1, addr)
+
+
+class CPU:
+    def __init__(self):
+        self.a_register = Register()
+        self.d_register = Register()
+        self.pc = PC()
+
+    def eval(self, in_m, instruction, reset):
+        # A-instruction: 0vvvvvvvvvvvvvvv
+        # C-instruction: 111accccccdddjjj
+        c_instruction = instruction[0]
+        a_instruction = Not(c_instruction)
+
+        a = instruction[3]
+        zx = instruction[4]
+        nx = instruction[5]
+        zy = instruction[6]
+        ny = instruction[7]
+        f = instruction[8]
+        no = instruction[9]
+        write_a = Or(a_instruction, And(c_instruction, instruction[10]))
+        write_d = And(c_instruction, instruction[11])
+        write_m = And(c_instruction, instruction[12])
+        lt = instruction[13]
+        eq = instruction[14]
+        gt = instruction[15]
+
+        a_register_out = self.a_register.val
+        d_register_out = self.d_register.val
+        pc_out = self.pc.val
+
+        a_or_m = Mux16(a_register_out, in_m, And(c_instruction, a))
+
+        alu_out, zr, ng = ALU(d_register_out, a_or_m,
+                              zx, nx, zy, ny, f, no)
+
+        jump = And(c_instruction,
+                   Or(Or(And(lt, ng),
+                         And(eq, zr)),
+                      And(gt, Not(Or(ng, zr)))))
+
+        # Clock the registers
+        self.a_register.eval(Mux16(instruction, alu_out, c_instruction),
+                             load=write_a)
+        self.d_register.eval(alu_out, load=write_d)
+        self.pc.eval(inp=a_register_out, load=jump, inc=1, reset=reset)
+
+        return alu_out, write_m, a_register_out, pc_out
+
+
+class Computer:
+    def __init__(self, program=(), decoded=True):
+        # With decoded=True the data memory is accessed with
+        # eval_decoded, otherwise every register is clocked on
+        # every cycle
+        self.rom = ROM32K(program)
+        self.cpu = CPU()
+        self.memory = Memory()
+        self.decoded = decoded
+        self.cycles = 0
+        self.elapsed = 0.0
+
+    def eval(self, reset=0):
+        memory_eval = self.memory.eval_decoded if self.decoded \
+                      else self.memory.eval
+
+        pc = self.cpu.pc.val
+        instruction = self.rom.eval(pc[1:])
+
+        address = self.cpu.a_register.val[1:]
+        in_m = memory_eval((0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0), 0, address)
+
+        out_m, write_m, address_m, _ = self.cpu.eval(in_m, instruction, reset)
+
+        memory_eval(out_m, write_m, address_m[1:])
+
+        self.cycles += 1
+        return self
+
+    def run(self, cycles):
+        start = time.perf_counter()
+        for _ in range(cycles):
+            self.eval()
+        self.elapsed += time.perf_counter() - start
+        return self
+
+    @property
+    def cycles_per_second(self):
+        return self.cycles / self.elapsed if self.elapsed else 0.0
+
+
+def run(hack_path, cycles, decoded=True):
+    computer = Computer(load_hack(hack_path), decoded=decoded)
+    return computer.run(cycles)
+
+
+if __name__ == '__main__':
+    import sys
+    hack_path = sys.argv[1]
+    cycles = int(sys.argv[2])
+
+    computer = run(hack_path, cycles)
+    print(f'{computer.cycles} cycles in {computer.elapsed:.3f}s: '
+          f'{computer.cycles_per_second:,.1f} cycles/s, '
+          f'{1e6 / computer.cycles_per_second:,.0f} us/cycle')
@@ -0,0 +1,332 @@
+import random
+import time
+from array import array
+from collections import Counter
+
+from logic import bus_to_word, word_to_bus
+from arithmetic import ALU
+from memory import Register, PC, GATE_RAMS
+from emulator import alu
+
+
+##########################################################
+# Sampled differential checking of the gate-level chips
+#
+# check_ram_equivalence in memory.py compares a RAM chip
+# against ArrayRAM on every step, which is fine for a few
+# thousand steps but far too slow for the long random
+# traces we want to trust the chips under. The checks here
+# drive a gate-level chip and a small int-based reference
+# model with the same random operation stream, but only
+# compare their outputs every `every` steps, and compare
+# their full state once at the end.
+#
+# Both sides are driven through every operation, reads
+# included, since a chip that disturbs its state on a read
+# is one of the faults being looked for; sampling only
+# saves the conversions and comparisons in between. The
+# one exception is the ALU, which holds no state, so an
+# evaluation whose output isn't compared can't affect
+# anything later.
+#
+# Register, RAM8, RAM64 and PC are driven through their
+# full gate-level eval. RAM512 and up are driven through
+# eval_decoded, which finds the addressed Register in
+# Python instead of through the DMux and Mux trees: a step
+# through the full trees clocks every Register the chip
+# has built and costs a third of a second on RAM16K.
+# check_ram_equivalence in memory.py checks both against
+# ArrayRAM (decoded=True for eval_decoded), so these still
+# cover the Registers and the address split at every
+# level, just not the trees themselves.
+#
+# When a sample or the final state disagrees, the trace is
+# replayed from its seed with every step compared, so the
+# report names the first step whose output diverged rather
+# than just the sample where it was noticed.
+##########################################################
+
+def _bits(word):
+    return f'{word:016b}'
+
+
+##########################################################
+# Int reference models
+##########################################################
+
+class RegisterModel:
+    def __init__(self):
+        self.val = 0
+
+    def eval(self, inp, load):
+        out = self.val
+        if load:
+            self.val = inp
+        return out
+
+
+class RAMModel:
+    def __init__(self, size):
+        self.size = size
+        self.words = array('H', bytes(2 * size))
+
+    def eval(self, inp, load, addr):
+        out = self.words[addr]
+        if load:
+            self.words[addr] = inp
+        return out
+
+
+class PCModel:
+    def __init__(self):
+        self.val = 0
+
+    def eval(self, inp, load, inc, reset):
+        out = self.val
+        if reset:
+            self.val = 0
+        elif load:
+            self.val = inp
+        elif inc:
+            self.val = (self.val + 1) & 0xFFFF
+        return out
+
+
+##########################################################
+# Gate chip / model pairs
+#
+# Each pair knows how to draw a random operation, apply it
+# to both sides and read back their full state as a list
+# of words. Operations are tuples of ints; gate_eval
+# returns None for steps whose output isn't sampled.
+##########################################################
+
+class RegisterPair:
+    def __init__(self):
+        self.name = 'Register'
+        self.gate = Register()
+        self.model = RegisterModel()
+
+    def operation(self, rng):
+        return rng.getrandbits(16), rng.getrandbits(1)
+
+    def describe(self, op):
+        return f'eval(inp={op[0]}, load={op[1]})'
+
+    def gate_eval(self, op, sample):
+        inp, load = op
+        out = self.gate.eval(word_to_bus(inp), load)
+        return bus_to_word(out) if sample else None
+
+    def model_eval(self, op):
+        return self.model.eval(*op)
+
+    def gate_state(self):
+        return [bus_to_word(self.gate.val)]
+
+    def model_state(self):
+        return [self.model.val]
+
+
+class RAMPair:
+    def __init__(self, size, decoded=False):
+        # With decoded=True the address is decoded in Python
+        # (eval_decoded) rather than through the chip's own
+        # DMux and Mux trees, which is faster but leaves that
+        # wiring unchecked
+        self.name = f'RAM{size}'
+        self.gate = GATE_RAMS[size]()
+        self.gate_chip_eval = self.gate.eval_decoded if decoded \
+                              else self.gate.eval
+        self.model = RAMModel(size)
+        self.addr_width = size.bit_length() - 1
+
+    def operation(self, rng):
+        return (rng.getrandbits(16), rng.getrandbits(1),
+                rng.getrandbits(self.addr_width))
+
+    def describe(self, op):
+        return f'eval(inp={op[0]}, load={op[1]}, addr={op[2]})'
+
+    def gate_eval(self, op, sample):
+        inp, load, addr = op
+        addr_bus = word_to_bus(addr)[16 - self.addr_width:]
+        out = self.gate_chip_eval(word_to_bus(inp), load, addr_bus)
+        return bus_to_word(out) if sample else None
+
+    def model_eval(self, op):
+        return self.model.eval(*op)
+
+    def gate_state(self):
+        # One line of bits per Register, in address order
+        return [int(line.replace(' ', ''), 2)
+                for line in str(self.gate).splitlines()]
+
+    def model_state(self):
+        return list(self.model.words)
+
+
+class PCPair:
+    def __init__(self):
+        self.name = 'PC'
+        self.gate = PC()
+        self.model = PCModel()
+
+    def operation(self, rng):
+        # Mostly counting, with the occasional load and the
+        # rare reset
+        return (rng.getrandbits(16), int(rng.random() < 0.25),
+                int(rng.random() < 0.75), int(rng.random() < 0.05))
+
+    def describe(self, op):
+        return (f'eval(inp={op[0]}, load={op[1]}, '
+                f'inc={op[2]}, reset={op[3]})')
+
+    def gate_eval(self, op, sample):
+        # PC.eval returns the chip itself, so its output is the
+        # value it held before the clock
+        inp, load, inc, reset = op
+        out = bus_to_word(self.gate.val) if sample else None
+        self.gate.eval(word_to_bus(inp), load, inc, reset)
+        return out
+
+    def model_eval(self, op):
+        return self.model.eval(*op)
+
+    def gate_state(self):
+        return [bus_to_word(self.gate.val)]
+
+    def model_state(self):
+        return [self.model.val]
+
+
+class ALUPair:
+    # The ALU holds no state, so it is only evaluated at the
+    # sampled steps
+    def __init__(self):
+        self.name = 'ALU'
+
+    def operation(self, rng):
+        return (rng.getrandbits(16), rng.getrandbits(16)) + \
+               tuple(rng.getrandbits(1) for _ in range(6))
+
+    def describe(self, op):
+        x, y, *bits = op
+        return f'ALU(x={x}, y={y}, zx nx zy ny f no={"".join(map(str, bits))})'
+
+    def gate_eval(self, op, sample):
+        if not sample:
+            return None
+        x, y, *bits = op
+        out, zr, ng = ALU(word_to_bus(x), word_to_bus(y), *bits)
+        return bus_to_word(out), zr, ng
+
+    def model_eval(self, op):
+        return alu(*op)
+
+    def gate_state(self):
+        return []
+
+    def model_state(self):
+        return []
+
+
+PAIRS = {
+    'Register': RegisterPair,
+    'RAM8': lambda: RAMPair(8),
+    'RAM64': lambda: RAMPair(64),
+    'RAM512': lambda: RAMPair(512, decoded=True),
+    'RAM4K': lambda: RAMPair(4096, decoded=True),
+    'RAM16K': lambda: RAMPair(16384, decoded=True),
+    'PC': PCPair,
+    'ALU': ALUPair,
+}
+
+
+##########################################################
+# Running traces
+##########################################################
+
+def _output_diff(pair, step, op, gate_out, model_out):
+    lines = [f'{pair.name} diverged at step {step}: {pair.describe(op)}']
+    if isinstance(model_out, tuple):
+        (gate_out, *gate_flags), (model_out, *model_flags) = gate_out, model_out
+        lines.append(f'  zr ng:  gate {gate_flags}, model {model_flags}')
+    lines.append(f'  gate:   {_bits(gate_out)} ({gate_out})')
+    lines.append(f'  model:  {_bits(model_out)} ({model_out})')
+    lines.append(f'  differ: {_bits(gate_out ^ model_out)}')
+    return '\n'.join(lines)
+
+def _state_diff(pair, gate_state, model_state, limit=8):
+    differing = [i for i, (g, m) in enumerate(zip(gate_state, model_state))
+                 if g != m]
+    lines = [f'{pair.name} final state differs at {len(differing)} '
+             f'address(es)']
+    for i in differing[:limit]:
+        lines.append(f'  [{i}] gate {_bits(gate_state[i])} ({gate_state[i]})'
+                     f', model {_bits(model_state[i])} ({model_state[i]})')
+    if len(differing) > limit:
+        lines.append(f'  ... and {len(differing) - limit} more')
+    return '\n'.join(lines)
+
+
+def _run(pair, steps, every, seed, stats):
+    # Returns None if every sample and the final state agree,
+    # otherwise (step, report) for the first disagreement seen
+    rng = random.Random(seed)
+    for step in range(steps):
+        op = pair.operation(rng)
+        sample = (step + 1) % every == 0
+        gate_out = pair.gate_eval(op, sample)
+        model_out = pair.model_eval(op)
+        if sample:
+            stats['compared'] += 1
+            if gate_out != model_out:
+                return step, _output_diff(pair, step, op, gate_out, model_out)
+
+    gate_state, model_state = pair.gate_state(), pair.model_state()
+    if gate_state != model_state:
+        return steps, _state_diff(pair, gate_state, model_state)
+    return None
+
+
+def check(name, steps=100_000, every=1000, seed=0, locate=True):
+    # Drive the named chip (a key of PAIRS) and its reference
+    # model through `steps` random operations, comparing
+    # outputs every `every` steps and the full state at the
+    # end. Raises AssertionError describing the divergence;
+    # with locate=True a failing trace is replayed comparing
+    # every step to find the first one that diverged.
+    stats = Counter(steps=steps)
+    start = time.perf_counter()
+    failure = _run(PAIRS[name](), steps, every, seed, stats)
+    stats['seconds'] = time.perf_counter() - start
+    if failure is None:
+        return stats
+
+    step, report = failure
+    if locate and every > 1:
+        replay = _run(PAIRS[name](), min(step + 1, steps), 1, seed, Counter())
+        if replay is not None:
+            noticed = f'step {step}' if step < steps else 'the final state'
+            report = (f'{replay[1]}\n'
+                      f'(noticed at {noticed} with every={every})')
+    raise AssertionError(report)
+
+
+def check_all(steps=100_000, every=1000, seed=0, names=None):
+    for name in names or PAIRS:
+        stats = check(name, steps, every, seed)
+        print(f'{name:<10} {stats["steps"]:>10,} steps '
+              f'{stats["compared"]:>8,} compared '
+              f'{stats["seconds"]:>8.2f}s')
+
+
+if __name__ == '__main__':
+    # python diffcheck.py [steps [every]] checks every chip in
+    # PAIRS, Register, RAM8, RAM64 and PC through their full
+    # gate-level eval and the larger RAMs through eval_decoded
+    import sys
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    every = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    check_all(steps, every)
@@ -0,0 +1,211 @@
+import time
+from array import array
+from pathlib import Path
+
+from assembler import BINARY_MAGIC, unpack
+
+
+##########################################################
+# A behavioural emulator for Hack programs
+#
+# computer.py runs .hack programs on the gate-level chips,
+# which is the point of this project but far too slow for
+# long programs. The emulator here runs the same machine
+# code with plain ints for A, D and PC and an array of
+# 16-bit words for the data memory. Every instruction is
+# decoded once, up front, into a tuple holding a function
+# that computes the ALU output and the destination/jump
+# fields, so the main loop does no bit twiddling at all.
+#
+# The ALU functions must agree with arithmetic.ALU bit for
+# bit; check_alu compares them against the chip for every
+# possible combination of control bits.
+##########################################################
+
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+
+def load_program(hack_path):
+    # Either the text .hack format or the assembler's packed
+    # binary format, told apart by the binary header's magic
+    with open(hack_path, 'rb') as f:
+        data = f.read()
+    if data.startswith(BINARY_MAGIC):
+        return unpack(data)
+    return array('H', (int(line, 2) for line in data.split() if line))
+
+
+def alu(x, y, zx, nx, zy, ny, f, no):
+    # Integer model of arithmetic.ALU
+    if zx:
+        x = 0
+    if nx:
+        x ^= 0xFFFF
+    if zy:
+        y = 0
+    if ny:
+        y ^= 0xFFFF
+    out = (x + y) & 0xFFFF if f else x & y
+    if no:
+        out ^= 0xFFFF
+    return out, int(out == 0), out >> 15
+
+
+# The comp field's six control bits, zx nx zy ny f no, for
+# the computations the assembler can produce, with x = D
+# and y = A or M
+COMPUTATIONS = {
+    0b101010: lambda x, y: 0,
+    0b111111: lambda x, y: 1,
+    0b111010: lambda x, y: 0xFFFF,
+    0b001100: lambda x, y: x,
+    0b110000: lambda x, y: y,
+    0b001101: lambda x, y: x ^ 0xFFFF,
+    0b110001: lambda x, y: y ^ 0xFFFF,
+    0b001111: lambda x, y: -x & 0xFFFF,
+    0b110011: lambda x, y: -y & 0xFFFF,
+    0b011111: lambda x, y: (x + 1) & 0xFFFF,
+    0b110111: lambda x, y: (y + 1) & 0xFFFF,
+    0b001110: lambda x, y: (x - 1) & 0xFFFF,
+    0b110010: lambda x, y: (y - 1) & 0xFFFF,
+    0b000010: lambda x, y: (x + y) & 0xFFFF,
+    0b010011: lambda x, y: (x - y) & 0xFFFF,
+    0b000111: lambda x, y: (y - x) & 0xFFFF,
+    0b000000: lambda x, y: x & y,
+    0b010101: lambda x, y: x | y,
+}
+
+def computation(control):
+    if control in COMPUTATIONS:
+        return COMPUTATIONS[control]
+
+    # Any other combination of control bits is still a valid
+    # instruction, so fall back on the full ALU model
+    bits = tuple((control >> (5 - i)) & 1 for i in range(6))
+    return lambda x, y: alu(x, y, *bits)[0]
+
+
+# The jump field, indexed by its three bits j1 j2 j3
+# (jump if out < 0, out = 0, out > 0)
+JUMPS = (
+    None,
+    lambda out: 0 < out < 0x8000,
+    lambda out: out == 0,
+    lambda out: out < 0x8000,
+    lambda out: out >= 0x8000,
+    lambda out: out != 0,
+    lambda out: out == 0 or out >= 0x8000,
+    lambda out: True,
+)
+
+
+def decode(instruction):
+    # A-instruction: (None, value, 0, 0, 0, None)
+    # C-instruction: (comp, uses_m, dest_a, dest_d, dest_m, jump)
+    if not instruction & 0x8000:
+        return None, instruction, 0, 0, 0, None
+
+    uses_m = (instruction >> 12) & 1
+    control = (instruction >> 6) & 0x3F
+    dest = (instruction >> 3) & 0b111
+    jump = instruction & 0b111
+
+    return (computation(control), uses_m,
+            dest & 0b100, dest & 0b010, dest & 0b001, JUMPS[jump])
+
+
+class Emulator:
+    def __init__(self, program):
+        # program is a path to a .hack or .hackbin file, a
+        # packed binary program as bytes, or a sequence of
+        # instruction words such as HackAssembler.assemble's
+        if isinstance(program, (str, Path)):
+            program = load_program(program)
+        elif isinstance(program, (bytes, bytearray)):
+            program = unpack(program)
+
+        self.rom = array('H', program)
+        padding = decode(0)
+        self.decoded = [decode(word) for word in self.rom] + \
+                       [padding] * (ROM_SIZE - len(self.rom))
+
+        self.ram = array('H', bytes(2 * RAM_SIZE))
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.elapsed = 0.0
+
+    def run(self, cycles):
+        start = time.perf_counter()
+
+        decoded = self.decoded
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+
+        for _ in range(cycles):
+            comp, arg, dest_a, dest_d, dest_m, jump = decoded[pc]
+            if comp is None:
+                a = arg
+                pc = (pc + 1) & 0x7FFF
+                continue
+
+            out = comp(d, ram[a & 0x7FFF] if arg else a)
+            if dest_m:
+                ram[a & 0x7FFF] = out
+            if jump is not None and jump(out):
+                pc = a & 0x7FFF
+            else:
+                pc = (pc + 1) & 0x7FFF
+            if dest_a:
+                a = out
+            if dest_d:
+                d = out
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        self.elapsed += time.perf_counter() - start
+        return self
+
+    @property
+    def cycles_per_second(self):
+        return self.cycles / self.elapsed if self.elapsed else 0.0
+
+
+def check_alu(samples=200, seed=0):
+    # Compare the integer ALU model and the predecoded
+    # computations against arithmetic.ALU for all 64
+    # combinations of control bits
+    import random
+    from arithmetic import ALU
+    from logic import word_to_bus, bus_to_word
+
+    rng = random.Random(seed)
+    values = [0, 1, 0x7FFF, 0x8000, 0xFFFF] + \
+             [rng.getrandbits(16) for _ in range(samples)]
+
+    for control in range(64):
+        bits = tuple((control >> (5 - i)) & 1 for i in range(6))
+        comp = computation(control)
+        for _ in range(samples):
+            x, y = rng.choice(values), rng.choice(values)
+            out, zr, ng = ALU(word_to_bus(x), word_to_bus(y), *bits)
+            expected = (bus_to_word(out), zr, ng)
+            if alu(x, y, *bits) != expected or comp(x, y) != expected[0]:
+                raise AssertionError(
+                    f'control {control:06b} with x={x}, y={y}: '
+                    f'ALU gives {expected}, emulator gives '
+                    f'{alu(x, y, *bits)} / {comp(x, y)}')
+
+
+if __name__ == '__main__':
+    import sys
+    hack_path = sys.argv[1]
+    cycles = int(sys.argv[2])
+
+    emulator = Emulator(hack_path).run(cycles)
+    print(f'{emulator.cycles} cycles in {emulator.elapsed:.3f}s: '
+          f'{emulator.cycles_per_second:,.0f} cycles/s')
@@ -0,0 +1,249 @@
+import time
+
+from assembler import Code
+from emulator import Emulator, alu
+
+
+##########################################################
+# A basic-block compiler for Hack programs
+#
+# The emulator still pays for a Python loop iteration, a
+# tuple unpack and a function call per instruction. Here we
+# instead translate straight-line runs of instructions into
+# the source of a single Python function that updates A, D
+# and the RAM with ordinary int expressions, and run a
+# program by dispatching from one compiled function to the
+# next.
+#
+# A basic block ends at every jump instruction, and a new
+# one starts at every jump target. Since Hack jumps to
+# whatever address is in A, targets are only known at run
+# time, so blocks are compiled the first time execution
+# reaches an address and cached by that address. When the
+# way out of a block is already decided at compile time --
+# it falls through, or ends in an unconditional jump to an
+# address loaded by an A-instruction -- the following block
+# is compiled into the same function, and conditional jumps
+# become early returns. If that chain leads back to the
+# address it started from, the function loops over it
+# itself for as long as the cycle budget allows, so a tight
+# loop like the one in Sum1ToN runs without leaving Python
+# code that was generated for it.
+##########################################################
+
+MAX_BLOCK_LENGTH = 256
+
+# Python expressions for the computations in the assembler's
+# comp table, keyed by the six ALU control bits, with x = D
+# and y = A or M
+COMP_MNEMONICS = ['0', '1', '-1', 'D', 'A', '!D', '!A', '-D', '-A',
+                  'D+1', 'A+1', 'D-1', 'A-1', 'D+A', 'D-A', 'A-D',
+                  'D&A', 'D|A']
+
+def _expression(mnemonic):
+    expr = mnemonic.replace('D', 'd').replace('A', '{y}') \
+                   .replace('!', '0xFFFF ^ ')
+    if '+' in expr or '-' in expr:
+        expr = f'({expr}) & 0xFFFF'
+    return expr
+
+COMP_EXPRESSIONS = {int(Code.comp(mnemonic)[1:], 2): _expression(mnemonic)
+                    for mnemonic in COMP_MNEMONICS}
+
+# Conditions on the ALU output, keyed by the jump field
+# exactly as assembler.Code.jump encodes it
+JUMP_CONDITIONS = {
+    'JGT': '0 < {out} < 0x8000',
+    'JEQ': '{out} == 0',
+    'JGE': '{out} < 0x8000',
+    'JLT': '{out} >= 0x8000',
+    'JNE': '{out} != 0',
+    'JLE': '{out} == 0 or {out} >= 0x8000',
+    'JMP': None,
+}
+JUMP_EXPRESSIONS = {int(Code.jump(mnemonic), 2): condition
+                    for mnemonic, condition in JUMP_CONDITIONS.items()}
+UNCONDITIONAL = int(Code.jump('JMP'), 2)
+
+
+class Block:
+    def __init__(self, start, length, source, function):
+        # length is the number of instructions executed by one
+        # pass through the block from start to its end
+        self.start = start
+        self.length = length
+        self.source = source
+        self.function = function
+
+
+def compile_block(rom, start):
+    # The generated function takes the RAM, A, D and the
+    # number of cycles it may run for, and returns the next
+    # PC, A, D and the number of cycles it actually ran.
+    # It is only called with a budget of at least one pass.
+    lines = []
+    a_value = None  # A's value when a constant is known to be in it
+    visited = set()
+    length = 0
+
+    def a_expr():
+        return 'a' if a_value is None else str(a_value)
+
+    def m_expr():
+        if a_value is None:
+            return 'ram[a & 0x7FFF]'
+        return f'ram[{a_value & 0x7FFF}]'
+
+    pc = start
+    while True:
+        visited.add(pc)
+        instruction = rom[pc] if pc < len(rom) else 0
+        length += 1
+        next_pc = (pc + 1) & 0x7FFF
+
+        if not instruction & 0x8000:
+            a_value = instruction
+        else:
+            uses_m = (instruction >> 12) & 1
+            control = (instruction >> 6) & 0x3F
+            dest = (instruction >> 3) & 0b111
+            jump = instruction & 0b111
+
+            y = m_expr() if uses_m else a_expr()
+            if control in COMP_EXPRESSIONS:
+                expr = COMP_EXPRESSIONS[control].format(y=y)
+            else:
+                bits = ', '.join(str((control >> (5 - i)) & 1)
+                                 for i in range(6))
+                expr = f'alu(d, {y}, {bits})[0]'
+            if 'a' not in expr and 'd' not in expr:
+                # Only constants involved, e.g. D=-1 or M=A+1 after
+                # an A-instruction
+                expr = str(eval(expr, {}))
+
+            targets = []
+            if dest & 0b001:
+                targets.append(m_expr())
+            if jump and a_value is None:
+                lines.append('target = a & 0x7FFF')
+            target = 'target' if a_value is None else a_value & 0x7FFF
+            if dest & 0b100:
+                targets.append('a')
+                a_value = None
+            if dest & 0b010:
+                targets.append('d')
+
+            # The output only needs a name of its own when it
+            # goes to several places or a jump tests it
+            out = None
+            if len(targets) == 1:
+                lines.append(f'{targets[0]} = {expr}')
+                if targets[0] in ('a', 'd'):
+                    out = targets[0]
+            elif targets or jump not in (0, UNCONDITIONAL):
+                lines.append(f'out = {expr}')
+                lines.extend(f'{t} = out' for t in targets)
+            if jump not in (0, UNCONDITIONAL) and out is None:
+                out = 'out'
+                if not targets and expr.isidentifier():
+                    out = expr
+                    lines.pop()
+                elif len(targets) == 1:
+                    lines[-1] = f'out = {expr}'
+                    lines.append(f'{targets[0]} = out')
+
+            if jump == UNCONDITIONAL:
+                if target == 'target' or (target in visited and
+                                          target != start):
+                    lines.append(f'return {target}, {a_expr()}, d, '
+                                 f'n + {length}')
+                    return _build(start, length, lines, loops=False)
+                next_pc = target
+            elif jump:
+                condition = JUMP_EXPRESSIONS[jump].format(out=out)
+                lines.append(f'if {condition}:')
+                lines.append(f'    return {target}, {a_expr()}, d, '
+                             f'n + {length}')
+
+        if next_pc == start:
+            if a_value is not None:
+                lines.append(f'a = {a_value}')
+            return _build(start, length, lines, loops=True)
+        if next_pc in visited or length >= MAX_BLOCK_LENGTH:
+            lines.append(f'return {next_pc}, {a_expr()}, d, n + {length}')
+            return _build(start, length, lines, loops=False)
+        pc = next_pc
+
+
+def _build(start, length, lines, loops):
+    body = ['n = 0']
+    if loops:
+        body.append('while True:')
+        body.extend(f'    {line}' for line in lines)
+        body.append(f'    n += {length}')
+        body.append(f'    if n + {length} > budget:')
+        body.append(f'        return {start}, a, d, n')
+    else:
+        body.extend(lines)
+
+    name = f'block_{start}'
+    source = f'def {name}(ram, a, d, budget):\n' + \
+             ''.join(f'    {line}\n' for line in body)
+    namespace = {'alu': alu}
+    exec(compile(source, f'<hack block {start}>', 'exec'), namespace)
+    return Block(start, length, source, namespace[name])
+
+
+class JITEmulator(Emulator):
+    def __init__(self, program, interpret=False):
+        # With interpret=True every run goes through the plain
+        # per-instruction emulator, which is handy when
+        # debugging the compiled blocks
+        super().__init__(program)
+        self.interpret = interpret
+        self.blocks = {}
+
+    def block_at(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            block = compile_block(self.rom, pc)
+            self.blocks[pc] = block
+        return block
+
+    def run(self, cycles):
+        if self.interpret:
+            return super().run(cycles)
+
+        start = time.perf_counter()
+        blocks = self.blocks
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+
+        remaining = cycles
+        while remaining > 0:
+            block = blocks.get(pc) or self.block_at(pc)
+            if block.length > remaining:
+                break
+            pc, a, d, ran = block.function(ram, a, d, remaining)
+            remaining -= ran
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles - remaining
+        self.elapsed += time.perf_counter() - start
+
+        # Finish off with the interpreter when the cycle budget
+        # ends in the middle of a block
+        if remaining:
+            super().run(remaining)
+        return self
+
+
+if __name__ == '__main__':
+    import sys
+    hack_path = sys.argv[1]
+    cycles = int(sys.argv[2])
+
+    emulator = JITEmulator(hack_path).run(cycles)
+    print(f'{emulator.cycles} cycles in {emulator.elapsed:.3f}s: '
+          f'{emulator.cycles_per_second:,.0f} cycles/s, '
+          f'{len(emulator.blocks)} blocks compiled')
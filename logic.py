@@ -1,3 +1,9 @@
+# Chips marked @truth_table can optionally be served from
+# precomputed lookup tables; see memo.py. This is off by
+# default and does not change how the chips are defined.
+from memo import truth_table
+
+
 ##########################################################
 # This is our axiomatic gate, so we can create it
 # with high-level Python constructs.
@@ -21,14 +27,17 @@ def And(a, b):
 def Or(a, b):
     return Nand(Not(a), Not(b))
 
+@truth_table
 def Xor(a, b):
     return Or(And(a, Not(b)),
               And(Not(a), b))
 
+@truth_table
 def Mux(a, b, sel):
     return Or(And(Not(sel), a),
               And(sel, b))
 
+@truth_table
 def DMux(inp, sel):
     a = And(Xor(inp, sel),
             Not(sel))
@@ -135,6 +144,14 @@ def Mux16(a, b, sel):
     return out15, out14, out13, out12, out11, out10, out9, out8, \
            out7,  out6,  out5,  out4,  out3,  out2,  out1, out0
 
+def Mux4(a, b, sel):
+    out0 = Mux(a[3], b[3], sel)
+    out1 = Mux(a[2], b[2], sel)
+    out2 = Mux(a[1], b[1], sel)
+    out3 = Mux(a[0], b[0], sel)
+
+    return out3, out2, out1, out0
+
 
 ##########################################################
 # Multi-way versions of some of the basic gates
@@ -174,6 +191,7 @@ def Mux8Way16(a, b, c, d, e, f, g, h, sel):
 
     return Mux16(abc_or_d, efg_or_h, sel2)
 
+@truth_table
 def DMux4Way(inp, sel):
     sel0 = sel[1]
     sel1 = sel[0]
@@ -187,6 +205,7 @@ def DMux4Way(inp, sel):
 
     return a, b, c, d
 
+@truth_table
 def DMux8Way(inp, sel):
     sel0 = sel[2]
     sel1 = sel[1]
@@ -209,6 +228,97 @@ def DMux8Way(inp, sel):
 
 
 
+##########################################################
+# Word-mode versions of the 16-bit gates
+#
+# The gates above carry a 16-bit bus as a tuple of bits and
+# wire up sixteen single-bit gates for every 16-bit gate.
+# In word mode a bus is instead a single int in 0..0xFFFF
+# and each gate drives all sixteen lanes at once, so a
+# call site can choose between the faithful tuple gates
+# and these much cheaper ones.
+#
+# Bit i of the int is lane i, i.e. inp[15] of a tuple bus
+# is bit 0 of the word and inp[0] is bit 15. Use
+# bus_to_word and word_to_bus to move between the two.
+#
+# The only primitive is Nand16, which is sixteen Nand
+# gates side by side; every other word-mode gate is built
+# from it in exactly the same way the single-bit gates
+# are built from Nand. Shifting a word or masking it with
+# a constant is not a gate, it is just rerouting wires
+# between lanes.
+##########################################################
+
+def bus_to_word(bus):
+    return int(''.join(map(str, bus)), 2)
+
+def word_to_bus(word):
+    return tuple(map(int, f'{word:016b}'))
+
+def Fanout16(bit):
+    # Wire a single bit to all sixteen lanes
+    return 0xFFFF * bit
+
+def Nand16(a, b):
+    return ~(a & b) & 0xFFFF
+
+def Not16Word(inp):
+    return Nand16(inp, inp)
+
+def And16Word(a, b):
+    return Not16Word(Nand16(a, b))
+
+def Or16Word(a, b):
+    return Nand16(Not16Word(a), Not16Word(b))
+
+def Xor16Word(a, b):
+    # The four-Nand Xor: cheaper than going through Or/And
+    # when every gate call costs the same on sixteen lanes
+    nand_ab = Nand16(a, b)
+    return Nand16(Nand16(a, nand_ab),
+                  Nand16(b, nand_ab))
+
+def Mux16Word(a, b, sel):
+    sel16 = Fanout16(sel)
+    return Nand16(Nand16(Not16Word(sel16), a),
+                  Nand16(sel16, b))
+
+def Or16WayWord(inp):
+    # Fold the upper half of the lanes onto the lower half
+    # until a single lane holds the Or of all sixteen
+    half  = Or16Word(inp, inp >> 8)
+    quart = Or16Word(half, half >> 4)
+    pair  = Or16Word(quart, quart >> 2)
+    out   = Or16Word(pair, pair >> 1)
+    return out & 1
+
+def Mux4Way16Word(a, b, c, d, sel):
+    sel0 = sel[1]
+    sel1 = sel[0]
+
+    a_or_b = Mux16Word(a, b, sel0)
+    c_or_d = Mux16Word(c, d, sel0)
+
+    return Mux16Word(a_or_b, c_or_d, sel1)
+
+def Mux8Way16Word(a, b, c, d, e, f, g, h, sel):
+    sel0 = sel[2]
+    sel1 = sel[1]
+    sel2 = sel[0]
+
+    a_or_b = Mux16Word(a, b, sel0)
+    c_or_d = Mux16Word(c, d, sel0)
+    e_or_f = Mux16Word(e, f, sel0)
+    g_or_h = Mux16Word(g, h, sel0)
+
+    abc_or_d = Mux16Word(a_or_b, c_or_d, sel1)
+    efg_or_h = Mux16Word(e_or_f, g_or_h, sel1)
+
+    return Mux16Word(abc_or_d, efg_or_h, sel2)
+
+
+
 ##########################################################
 # Now we build the computer architecture from the ALU,
 # RAM, and other components we have built so far.
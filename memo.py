@@ -0,0 +1,96 @@
+import functools
+import inspect
+import itertools
+from collections import Counter
+from contextlib import contextmanager
+
+
+##########################################################
+# Truth-table memoization for small combinational chips
+#
+# Chips like Xor, Mux and FullAdder take only a handful of
+# input bits, yet every call walks their whole tree of
+# gates down to Nand. A chip decorated with @truth_table
+# can instead be served from a lookup table: the first
+# time it is called while memoization is enabled, its full
+# truth table is computed once from its Nand-based
+# definition, and later calls are a single dict lookup.
+#
+# Memoization is off by default so that plain runs still
+# exercise every gate; call enable() to turn it on. Calls
+# whose arguments are not all 0/1 bits (for example the
+# symbolic wires used by netlist.trace) always go through
+# the chip's real definition.
+##########################################################
+
+enabled = False
+hits = Counter()
+tables = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+@contextmanager
+def disabled():
+    global enabled
+    was_enabled = enabled
+    enabled = False
+    try:
+        yield
+    finally:
+        enabled = was_enabled
+
+def reset_stats():
+    hits.clear()
+
+
+def _is_bits(args):
+    return all(_is_bits(arg) if isinstance(arg, tuple) else arg in (0, 1)
+               for arg in args)
+
+def _all_inputs(args):
+    # Every combination of bits with the same shape as args,
+    # e.g. (inp, (s1, s0)) for DMux4Way
+    shapes = [len(arg) if isinstance(arg, tuple) else None for arg in args]
+    width = sum(1 if shape is None else shape for shape in shapes)
+
+    for bits in itertools.product((0, 1), repeat=width):
+        bits = iter(bits)
+        yield tuple(next(bits) if shape is None
+                    else tuple(next(bits) for _ in range(shape))
+                    for shape in shapes)
+
+def _build(chip, args):
+    with disabled():
+        return {inputs: chip(*inputs) for inputs in _all_inputs(args)}
+
+
+def truth_table(chip):
+    name = chip.__name__
+    table = tables.setdefault(name, {})
+    params = tuple(inspect.signature(chip).parameters)
+
+    @functools.wraps(chip)
+    def memoized(*args, **kwargs):
+        if not enabled:
+            return chip(*args, **kwargs)
+
+        if kwargs:
+            args += tuple(kwargs[param] for param in params[len(args):])
+        try:
+            out = table[args]
+        except (KeyError, TypeError):
+            if table or not _is_bits(args):
+                return chip(*args)
+            table.update(_build(chip, args))
+            out = table[args]
+        hits[name] += 1
+        return out
+
+    return memoized
@@ -1,3 +1,7 @@
+import random
+from array import array
+from collections import Counter
+
 from logic import *
 from arithmetic import Inc16
 
@@ -64,6 +68,8 @@ class Bit:
 
 
 class Register:
+    size = 1
+
     def __init__(self):
         self.bit0  = Bit()
         self.bit1  = Bit()
@@ -103,6 +109,10 @@ class Register:
         return out15, out14, out13, out12, out11, out10, out9, out8, \
                out7, out6, out5, out4, out3, out2, out1, out0
     
+    # A single register has no address to decode
+    def eval_decoded(self, inp, load):
+        return self.eval(inp, load)
+
     @property
     def val(self):        
         return (self.bit15.val, self.bit14.val, self.bit13.val, self.bit12.val,
@@ -120,16 +130,99 @@ class Register:
         return str(self)
 
 
+class Lazy:
+    # Stands in for one of the sub-chips of a RAM chip and
+    # only builds it the first time something is loaded into
+    # it. Until then nothing has ever been stored, so every
+    # address still holds zero and evaluating it with load=0
+    # can only output zero. This makes a gate-level RAM16K
+    # cost memory in proportion to the addresses that are
+    # actually written rather than its full size.
+    def __init__(self, chip_class):
+        self.chip_class = chip_class
+        self.chip = None
+
+    def _built(self, load):
+        # The real chip, or None while it could only output zero
+        if self.chip is None and load:
+            self.chip = self.chip_class()
+        return self.chip
+
+    def eval(self, inp, load, *addr):
+        chip = self._built(load)
+        if chip is None:
+            return (0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0)
+        return chip.eval(inp, load, *addr)
+
+    def eval_decoded(self, inp, load, *addr):
+        chip = self._built(load)
+        if chip is None:
+            return (0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0)
+        return chip.eval_decoded(inp, load, *addr)
+
+    def __str__(self):
+        if self.chip is None:
+            zero = ' '.join('0' * 16)
+            return '\n'.join([zero] * self.chip_class.size)
+        return str(self.chip)
+
+    def __repr__(self):
+        return str(self)
+
+
+def materialized(chip, counts=None):
+    # Count the sub-chips of a RAM that have actually been
+    # built, by class name
+    if counts is None:
+        counts = Counter()
+    if isinstance(chip, Lazy):
+        if chip.chip is not None:
+            materialized(chip.chip, counts)
+        return counts
+
+    counts[type(chip).__name__] += 1
+    for i in range(8):
+        sub_chip = getattr(chip, f'r{i}', None)
+        if sub_chip is not None:
+            materialized(sub_chip, counts)
+    return counts
+
+
+##########################################################
+# Address-decoded evaluation of the RAM chips
+#
+# Each RAM chip's eval clocks every one of its sub-chips,
+# so a single access to a RAM16K evaluates all 16,384
+# Registers. But the DMux8Way/DMux4Way that drives the
+# load lines sends load=0 to every sub-chip except the
+# addressed one, and a Register evaluated with load=0 just
+# stores the value it already held. Its output is then
+# thrown away by the Mux8Way16/Mux4Way16 that only passes
+# the addressed sub-chip through. Skipping every sub-chip
+# but the addressed one therefore leaves both the outputs
+# and the stored state exactly as the full evaluation
+# would.
+#
+# eval_decoded does just that: it uses the address to
+# pick the one sub-chip on the path to the addressed
+# Register and only evaluates that, so an access costs
+# one Register plus one step per level of the hierarchy
+# rather than the whole memory. eval is still the
+# faithful, everything-is-clocked version.
+##########################################################
+
 class RAM8:
+    size = 8
+
     def __init__(self):
-        self.r0 = Register()
-        self.r1 = Register()
-        self.r2 = Register()
-        self.r3 = Register()
-        self.r4 = Register()
-        self.r5 = Register()
-        self.r6 = Register()
-        self.r7 = Register()
+        self.r0 = Lazy(Register)
+        self.r1 = Lazy(Register)
+        self.r2 = Lazy(Register)
+        self.r3 = Lazy(Register)
+        self.r4 = Lazy(Register)
+        self.r5 = Lazy(Register)
+        self.r6 = Lazy(Register)
+        self.r7 = Lazy(Register)
 
     def eval(self, inp, load, addr):
         ld0, ld1, ld2, ld3, ld4, ld5, ld6, ld7 = DMux8Way(load, sel=addr)
@@ -145,6 +238,10 @@ class RAM8:
 
         return Mux8Way16(out0, out1, out2, out3, out4, out5, out6, out7, sel=addr)
     
+    def eval_decoded(self, inp, load, addr):
+        register = getattr(self, f'r{bus_to_word(addr)}')
+        return register.eval_decoded(inp, load)
+
     def __str__(self):
         return f'{self.r0}\n{self.r1}\n{self.r2}\n{self.r3}\n' + \
                f'{self.r4}\n{self.r5}\n{self.r6}\n{self.r7}'
@@ -154,15 +251,17 @@ class RAM8:
 
 
 class RAM64:
+    size = 64
+
     def __init__(self):
-        self.r0 = RAM8()
-        self.r1 = RAM8()
-        self.r2 = RAM8()
-        self.r3 = RAM8()
-        self.r4 = RAM8()
-        self.r5 = RAM8()
-        self.r6 = RAM8()
-        self.r7 = RAM8()
+        self.r0 = Lazy(RAM8)
+        self.r1 = Lazy(RAM8)
+        self.r2 = Lazy(RAM8)
+        self.r3 = Lazy(RAM8)
+        self.r4 = Lazy(RAM8)
+        self.r5 = Lazy(RAM8)
+        self.r6 = Lazy(RAM8)
+        self.r7 = Lazy(RAM8)
     
     def eval(self, inp, load, addr):
         msb_addr = (addr[0], addr[1], addr[2])
@@ -181,6 +280,13 @@ class RAM64:
 
         return Mux8Way16(out0, out1, out2, out3, out4, out5, out6, out7, sel=msb_addr)
 
+    def eval_decoded(self, inp, load, addr):
+        msb_addr = (addr[0], addr[1], addr[2])
+        lsb_addr = (addr[3], addr[4], addr[5])
+
+        ram = getattr(self, f'r{bus_to_word(msb_addr)}')
+        return ram.eval_decoded(inp, load, lsb_addr)
+
     def __str__(self):
         return f'{self.r0}\n{self.r1}\n{self.r2}\n{self.r3}\n' + \
                f'{self.r4}\n{self.r5}\n{self.r6}\n{self.r7}'
@@ -190,15 +296,17 @@ class RAM64:
 
 
 class RAM512:
+    size = 512
+
     def __init__(self):
-        self.r0 = RAM64()
-        self.r1 = RAM64()
-        self.r2 = RAM64()
-        self.r3 = RAM64()
-        self.r4 = RAM64()
-        self.r5 = RAM64()
-        self.r6 = RAM64()
-        self.r7 = RAM64()
+        self.r0 = Lazy(RAM64)
+        self.r1 = Lazy(RAM64)
+        self.r2 = Lazy(RAM64)
+        self.r3 = Lazy(RAM64)
+        self.r4 = Lazy(RAM64)
+        self.r5 = Lazy(RAM64)
+        self.r6 = Lazy(RAM64)
+        self.r7 = Lazy(RAM64)
     
     def eval(self, inp, load, addr):
         msb_addr = (addr[0], addr[1], addr[2])
@@ -217,6 +325,13 @@ class RAM512:
 
         return Mux8Way16(out0, out1, out2, out3, out4, out5, out6, out7, sel=msb_addr)
 
+    def eval_decoded(self, inp, load, addr):
+        msb_addr = (addr[0], addr[1], addr[2])
+        lsb_addr = (addr[3], addr[4], addr[5], addr[6], addr[7], addr[8])
+
+        ram = getattr(self, f'r{bus_to_word(msb_addr)}')
+        return ram.eval_decoded(inp, load, lsb_addr)
+
     def __str__(self):
         return f'{self.r0}\n{self.r1}\n{self.r2}\n{self.r3}\n' + \
                f'{self.r4}\n{self.r5}\n{self.r6}\n{self.r7}'
@@ -226,15 +341,17 @@ class RAM512:
 
 
 class RAM4K:
+    size = 4096
+
     def __init__(self):
-        self.r0 = RAM512()
-        self.r1 = RAM512()
-        self.r2 = RAM512()
-        self.r3 = RAM512()
-        self.r4 = RAM512()
-        self.r5 = RAM512()
-        self.r6 = RAM512()
-        self.r7 = RAM512()
+        self.r0 = Lazy(RAM512)
+        self.r1 = Lazy(RAM512)
+        self.r2 = Lazy(RAM512)
+        self.r3 = Lazy(RAM512)
+        self.r4 = Lazy(RAM512)
+        self.r5 = Lazy(RAM512)
+        self.r6 = Lazy(RAM512)
+        self.r7 = Lazy(RAM512)
     
     def eval(self, inp, load, addr):
         msb_addr = (addr[0], addr[1], addr[2])
@@ -255,6 +372,15 @@ class RAM4K:
 
         return Mux8Way16(out0, out1, out2, out3, out4, out5, out6, out7, sel=msb_addr)
 
+    def eval_decoded(self, inp, load, addr):
+        msb_addr = (addr[0], addr[1], addr[2])
+        lsb_addr = (addr[3], addr[4], addr[5],
+                    addr[6], addr[7], addr[8],
+                    addr[9], addr[10], addr[11])
+
+        ram = getattr(self, f'r{bus_to_word(msb_addr)}')
+        return ram.eval_decoded(inp, load, lsb_addr)
+
     def __str__(self):
         return f'{self.r0}\n{self.r1}\n{self.r2}\n{self.r3}\n' + \
                f'{self.r4}\n{self.r5}\n{self.r6}\n{self.r7}'
@@ -264,11 +390,13 @@ class RAM4K:
 
 
 class RAM16K:
+    size = 16384
+
     def __init__(self):
-        self.r0 = RAM4K()
-        self.r1 = RAM4K()
-        self.r2 = RAM4K()
-        self.r3 = RAM4K()
+        self.r0 = Lazy(RAM4K)
+        self.r1 = Lazy(RAM4K)
+        self.r2 = Lazy(RAM4K)
+        self.r3 = Lazy(RAM4K)
     
     def eval(self, inp, load, addr):
         msb_addr = (addr[0], addr[1])
@@ -286,6 +414,16 @@ class RAM16K:
 
         return Mux4Way16(out0, out1, out2, out3, sel=msb_addr)
 
+    def eval_decoded(self, inp, load, addr):
+        msb_addr = (addr[0], addr[1])
+        lsb_addr = (addr[2], addr[3], addr[4],
+                    addr[5], addr[6], addr[7],
+                    addr[8], addr[9], addr[10],
+                    addr[11], addr[12], addr[13])
+
+        ram = getattr(self, f'r{bus_to_word(msb_addr)}')
+        return ram.eval_decoded(inp, load, lsb_addr)
+
     def __str__(self):
         return f'{self.r0}\n{self.r1}\n{self.r2}\n{self.r3}'
 
@@ -343,3 +481,74 @@ class PC:
     
     def __repr__(self):
         return str(self)
+
+
+##########################################################
+# Array-backed RAM
+#
+# The gate-level RAM chips above are faithful but huge: a
+# RAM16K is 16,384 Registers made of 262,144 Bits and as
+# many DFFs. ArrayRAM is a drop-in replacement with the
+# same eval(inp, load, addr) interface and the same str()
+# output that keeps its contents in an array of 16-bit
+# words instead. It is *not* built from gates; use it when
+# only the behaviour of the memory matters, and
+# check_ram_equivalence to confirm it still matches the
+# gate-level chips.
+##########################################################
+
+class ArrayRAM:
+    def __init__(self, size=16384):
+        self.size = size
+        self.words = array('H', bytes(2 * size))
+
+    def eval(self, inp, load, addr):
+        # Like the gate-level chips, output the contents from
+        # before this clock cycle's load
+        index = bus_to_word(addr)
+        out = self.words[index]
+        if load:
+            self.words[index] = bus_to_word(inp)
+        return word_to_bus(out)
+
+    def __str__(self):
+        return '\n'.join(' '.join(f'{word:016b}') for word in self.words)
+
+    def __repr__(self):
+        return str(self)
+
+
+GATE_RAMS = {
+    8: RAM8,
+    64: RAM64,
+    512: RAM512,
+    4096: RAM4K,
+    16384: RAM16K,
+}
+
+def check_ram_equivalence(size=64, steps=1000, seed=0, decoded=False):
+    # Drive a gate-level RAM and an ArrayRAM of the same size
+    # with the same random trace, comparing every output and
+    # the final contents. With decoded=True the gate-level RAM
+    # is driven through eval_decoded instead of eval.
+    gate_ram = GATE_RAMS[size]()
+    gate_eval = gate_ram.eval_decoded if decoded else gate_ram.eval
+    array_ram = ArrayRAM(size)
+    addr_width = size.bit_length() - 1
+    rng = random.Random(seed)
+
+    for step in range(steps):
+        inp = word_to_bus(rng.getrandbits(16))
+        load = rng.getrandbits(1)
+        addr = tuple(rng.getrandbits(1) for _ in range(addr_width))
+
+        expected = gate_eval(inp, load, addr)
+        actual = array_ram.eval(inp, load, addr)
+        if actual != expected:
+            raise AssertionError(
+                f'step {step}: eval({bus_to_word(inp)}, {load}, '
+                f'{bus_to_word(addr)}) returned {bus_to_word(actual)}, '
+                f'gate-level RAM{size} returned {bus_to_word(expected)}')
+
+    if str(array_ram) != str(gate_ram):
+        raise AssertionError(f'final contents differ from RAM{size}')
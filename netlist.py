@@ -0,0 +1,315 @@
+import functools
+import inspect
+from contextlib import contextmanager
+
+import logic
+import memo
+from arithmetic import Add16, CarryLookaheadAdd16, CarrySelectAdd16, \
+                       KoggeStoneAdd16, Inc16, ALU
+
+
+##########################################################
+# Tracing chips into Nand netlists
+#
+# Every chip in logic.py and arithmetic.py eventually
+# bottoms out in calls to Nand, so if we run a chip once
+# with symbolic wires instead of 0s and 1s and record each
+# Nand call, we get the chip's full netlist: a DAG whose
+# nodes are constants, input bits and Nand gates. That
+# netlist can be inspected (gate count, critical path) and
+# compiled into a single flat Python function that
+# evaluates the Nand gates in order, skipping the whole
+# tree of intermediate gate calls.
+#
+# Node ids 0 and 1 are always the constants 0 and 1, so a
+# node id can stand in for a constant bit directly.
+##########################################################
+
+CONST0 = 0
+CONST1 = 1
+
+
+class Wire:
+    __slots__ = ('node',)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __repr__(self):
+        return f'Wire(n{self.node})'
+
+
+class Netlist:
+    def __init__(self, name, params):
+        # params is a list of (name, width) pairs in signature
+        # order; a width of 1 is a plain bit, anything wider is
+        # a tuple bus like those used throughout logic.py.
+        self.name = name
+        self.params = params
+        self.nodes = [('const', 0), ('const', 1)]
+        self.outputs = None
+
+    def add(self, node):
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def node_of(self, value):
+        if isinstance(value, Wire):
+            return value.node
+        if value in (0, 1):
+            return CONST1 if value else CONST0
+        raise TypeError(f'cannot wire {value!r} into a netlist')
+
+    @property
+    def output_nodes(self):
+        return list(_leaves(self.outputs))
+
+    def live_nodes(self):
+        # Ids of every node the outputs depend on, in
+        # topological order
+        live = set()
+        stack = self.output_nodes
+        while stack:
+            n = stack.pop()
+            if n in live:
+                continue
+            live.add(n)
+            if self.nodes[n][0] == 'nand':
+                stack.extend(self.nodes[n][1:])
+        return sorted(live)
+
+    @property
+    def gate_count(self):
+        return sum(1 for n in self.live_nodes() if self.nodes[n][0] == 'nand')
+
+    @property
+    def depth(self):
+        # Length of the longest chain of Nand gates between an
+        # input (or constant) and an output
+        level = {}
+        for n in self.live_nodes():
+            node = self.nodes[n]
+            if node[0] == 'nand':
+                level[n] = 1 + max(level[node[1]], level[node[2]])
+            else:
+                level[n] = 0
+        return max((level[n] for n in self.output_nodes), default=0)
+
+    def dump(self):
+        lines = [f'# {self.name}: {self.gate_count} nand gates, '
+                 f'depth {self.depth}']
+        for n in self.live_nodes():
+            kind, *args = self.nodes[n]
+            if kind == 'const':
+                lines.append(f'n{n} = {args[0]}')
+            elif kind == 'input':
+                lines.append(f'n{n} = input {_input_expr(*args)}')
+            else:
+                lines.append(f'n{n} = nand n{args[0]} n{args[1]}')
+        lines.append(f'out = {_format_outputs(self.outputs, "n{}".format)}')
+        return '\n'.join(lines)
+
+    def source(self, name=None):
+        name = name or self.name
+        signature = ', '.join(param for param, _ in self.params)
+        body = []
+        for n in self.live_nodes():
+            kind, *args = self.nodes[n]
+            if kind == 'input':
+                body.append(f'n{n} = {_input_expr(*args)}')
+            elif kind == 'nand':
+                a, b = (self._operand(m) for m in args)
+                body.append(f'n{n} = 1 ^ ({a} & {b})')
+        outputs = _format_outputs(self.outputs, self._operand)
+        body.append(f'return {outputs}')
+        return f'def {name}({signature}):\n' + \
+               ''.join(f'    {line}\n' for line in body)
+
+    def _operand(self, n):
+        # Constants are inlined as literals in generated code
+        node = self.nodes[n]
+        return str(node[1]) if node[0] == 'const' else f'n{n}'
+
+    def compile(self, chip=None):
+        namespace = {}
+        exec(compile(self.source(), f'<netlist {self.name}>', 'exec'),
+             namespace)
+        fn = namespace[self.name]
+        if chip is not None:
+            functools.update_wrapper(fn, chip)
+            # Options like ALU's adder are fixed at trace time,
+            # so fn keeps its own signature rather than the chip's
+            del fn.__wrapped__
+        fn.netlist = self
+        return fn
+
+
+def _leaves(outputs):
+    if isinstance(outputs, tuple):
+        for out in outputs:
+            yield from _leaves(out)
+    else:
+        yield outputs
+
+def _input_expr(param, index):
+    return param if index is None else f'{param}[{index}]'
+
+def _format_outputs(outputs, leaf):
+    if isinstance(outputs, tuple):
+        inner = ', '.join(_format_outputs(out, leaf) for out in outputs)
+        return f'({inner},)' if len(outputs) == 1 else f'({inner})'
+    return leaf(outputs)
+
+def _map_outputs(netlist, value):
+    if isinstance(value, tuple):
+        return tuple(_map_outputs(netlist, v) for v in value)
+    return netlist.node_of(value)
+
+
+@contextmanager
+def _tracing(netlist):
+    def Nand(a, b):
+        return Wire(netlist.add(('nand', netlist.node_of(a),
+                                         netlist.node_of(b))))
+
+    # Memoized chips must run their real definitions so that
+    # every Nand is recorded
+    original = logic.Nand
+    logic.Nand = Nand
+    try:
+        with memo.disabled():
+            yield
+    finally:
+        logic.Nand = original
+
+
+def trace(chip, **widths):
+    # Widths are given per parameter name and default to 1,
+    # e.g. trace(Add16, a=16, b=16). Parameters with default
+    # values, like ALU's adder, are options rather than wires
+    # and are left at their defaults.
+    params = [(name, widths.get(name, 1))
+              for name, param in inspect.signature(chip).parameters.items()
+              if param.default is param.empty]
+    netlist = Netlist(chip.__name__, params)
+
+    args = []
+    for name, width in params:
+        if width == 1:
+            args.append(Wire(netlist.add(('input', name, None))))
+        else:
+            args.append(tuple(Wire(netlist.add(('input', name, i)))
+                              for i in range(width)))
+
+    with _tracing(netlist):
+        outputs = chip(*args)
+
+    netlist.outputs = _map_outputs(netlist, outputs)
+    return netlist
+
+
+##########################################################
+# Optimizing traced netlists
+#
+# A traced netlist contains every Nand the chip's Python
+# definition calls, including gates fed by constants (the
+# zero16 bus in ALU, the constant 1 in Inc16), double
+# negations from And/Or being built on Not, and identical
+# gates built more than once (DMux8Way computes Not(sel2)
+# four times). optimize rebuilds the netlist one node at a
+# time, applying these rewrites to each Nand:
+#
+#   Nand(0, x)       -> 1
+#   Nand(1, 1)       -> 0
+#   Nand(1, x)       -> Nand(x, x)
+#   Nand(x, Not(x))  -> 1
+#   Not(Not(x))      -> x
+#
+# and hash-consing the result so structurally identical
+# gates are only built once. Nodes no longer reachable from
+# the outputs are dropped by live_nodes as usual.
+##########################################################
+
+class _Builder:
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.gates = {}
+
+    def negated(self, n):
+        # The node n is Not(x) for this x, or None
+        node = self.netlist.nodes[n]
+        if node[0] == 'nand' and node[1] == node[2]:
+            return node[1]
+        return None
+
+    def nand(self, a, b):
+        if a == CONST0 or b == CONST0:
+            return CONST1
+        if a == CONST1 and b == CONST1:
+            return CONST0
+        if a == CONST1:
+            a = b
+        elif b == CONST1:
+            b = a
+
+        if a == b and self.negated(a) is not None:
+            return self.negated(a)
+        if self.negated(a) == b or self.negated(b) == a:
+            return CONST1
+
+        key = (a, b) if a <= b else (b, a)
+        if key not in self.gates:
+            self.gates[key] = self.netlist.add(('nand',) + key)
+        return self.gates[key]
+
+
+def optimize(netlist):
+    optimized = Netlist(netlist.name, netlist.params)
+    builder = _Builder(optimized)
+
+    new_id = {CONST0: CONST0, CONST1: CONST1}
+    for n, node in enumerate(netlist.nodes):
+        if node[0] == 'input':
+            new_id[n] = optimized.add(node)
+        elif node[0] == 'nand':
+            new_id[n] = builder.nand(new_id[node[1]], new_id[node[2]])
+
+    optimized.outputs = _remap_outputs(netlist.outputs, new_id)
+    return optimized
+
+def _remap_outputs(outputs, new_id):
+    if isinstance(outputs, tuple):
+        return tuple(_remap_outputs(out, new_id) for out in outputs)
+    return new_id[outputs]
+
+
+def compile_chip(chip, optimized=True, **widths):
+    netlist = trace(chip, **widths)
+    if optimized:
+        netlist = optimize(netlist)
+    return netlist.compile(chip)
+
+
+def report(netlists):
+    print(f'{"chip":<20} {"gates":>7} {"depth":>6} '
+          f'{"opt gates":>10} {"opt depth":>10}')
+    for netlist in netlists:
+        optimized = optimize(netlist)
+        print(f'{netlist.name:<20} {netlist.gate_count:>7} '
+              f'{netlist.depth:>6} {optimized.gate_count:>10} '
+              f'{optimized.depth:>10}')
+
+
+if __name__ == '__main__':
+    report([
+        trace(logic.DMux4Way, sel=2),
+        trace(logic.DMux8Way, sel=3),
+        trace(logic.Mux8Way16, a=16, b=16, c=16, d=16,
+                               e=16, f=16, g=16, h=16, sel=3),
+        trace(Add16, a=16, b=16),
+        trace(CarryLookaheadAdd16, a=16, b=16),
+        trace(CarrySelectAdd16, a=16, b=16),
+        trace(KoggeStoneAdd16, a=16, b=16),
+        trace(Inc16, inp=16),
+        trace(ALU, x=16, y=16),
+    ])
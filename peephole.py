@@ -0,0 +1,300 @@
+import re
+
+
+##########################################################
+# A peephole optimizer for the VM translator's assembly
+#
+# CodeWriter translates each VM command on its own into a
+# fixed sequence of instructions: a push always stores D at
+# RAM[SP] and increments SP, a binary operation pops both
+# operands (the first through R13) and pushes the result,
+# and so on. Adjacent commands therefore produce sequences
+# that undo each other or could be done far more directly.
+# optimize rewrites the stream of assembly lines with a set
+# of rules, each replacing a fixed window of instructions
+# with a shorter one that leaves memory, SP, and whichever
+# of A and D are still needed exactly as before:
+#
+#   pop prefix      @SP M=M-1 @SP A=M     -> @SP AM=M-1
+#   push D          @SP A=M M=D @SP M=M+1 -> @SP M=M+1 A=M-1 M=D
+#   binary op       pop, pop, op, push    -> @SP AM=M-1 D=M A=A-1 M=M-D
+#   unary op        pop, op, push         -> @SP A=M-1 M=-M
+#   push then pop   push D, pop D         -> (nothing)
+#   push 0/1        @1 D=A, push D        -> ..., M=1
+#   pop to a fixed address or a small segment offset
+#                   without going through R13
+#
+# plus dropping @ instructions that reload the value A
+# already holds and instructions that only set A when
+# nothing reads A afterwards.
+#
+# The rules rely on two things about CodeWriter's output:
+# R13 is scratch space whose value never outlives a single
+# VM command, and stack memory at or above SP is dead, so
+# a push that is immediately popped need not be written.
+#
+# Whether A or D is still needed is decided by _live, which
+# follows the instructions after a window (through labels
+# and into the targets of jumps to known labels) until the
+# register is read or overwritten.
+##########################################################
+
+SEGMENTS = r'(?P<seg>LCL|ARG|THIS|THAT)'
+
+# Each rule is (pattern, replacement, dead). The pattern is
+# a list of consecutive instructions, matched literally
+# unless they contain named groups (?P<...>), which makes
+# them regexes; the replacement is a function of the named
+# groups they matched; and dead lists the registers that
+# must not be read after the window for the replacement to
+# be valid.
+RULES = [
+    (['@SP', 'M=M-1', '@SP', 'A=M'],
+     lambda g: ['@SP', 'AM=M-1'],
+     ''),
+
+    # x op y computed into D: pop y to R13, pop x to D,
+    # D=D op R13
+    (['@SP', 'AM=M-1', 'D=M', '@R13', 'M=D',
+      '@SP', 'AM=M-1', 'D=M', '@R13', r'D=D(?P<op>[-+&|])M'],
+     lambda g: ['@SP', 'AM=M-1', 'D=M', '@SP', 'AM=M-1',
+                'D=M-D' if g['op'] == '-' else f'D=D{g["op"]}M'],
+     'A'),
+
+    (['@SP', 'A=M', 'M=D', '@SP', 'M=M+1'],
+     lambda g: ['@SP', 'M=M+1', 'A=M-1', 'M=D'],
+     'A'),
+
+    # Binary and unary operations done in place on the
+    # stack top, leaving the operand rather than the result
+    # in D
+    (['@SP', 'AM=M-1', 'D=M', '@SP', 'AM=M-1',
+      r'D=(?P<expr>D[+&|]M|M-D)', '@SP', 'M=M+1', 'A=M-1', 'M=D'],
+     lambda g: ['@SP', 'AM=M-1', 'D=M', 'A=A-1', f'M={g["expr"]}'],
+     'D'),
+
+    (['@SP', 'AM=M-1', 'D=M', r'D=(?P<op>[-!])D',
+      '@SP', 'M=M+1', 'A=M-1', 'M=D'],
+     lambda g: ['@SP', 'A=M-1', f'M={g["op"]}M'],
+     'D'),
+
+    # Pops straight to the destination instead of through R13
+    (['@(?P<addr>.+)', 'D=A', '@R13', 'M=D',
+      '@SP', 'AM=M-1', 'D=M', '@R13', 'A=M', 'M=D'],
+     lambda g: ['@SP', 'AM=M-1', 'D=M', f'@{g["addr"]}', 'M=D'],
+     ''),
+
+    ([f'@{SEGMENTS}', 'D=M', r'@(?P<i>[0-5])', 'D=D+A', '@R13', 'M=D',
+      '@SP', 'AM=M-1', 'D=M', '@R13', 'A=M', 'M=D'],
+     lambda g: ['@SP', 'AM=M-1', 'D=M', f'@{g["seg"]}'] +
+               _offset(int(g['i'])) + ['M=D'],
+     ''),
+
+    ([f'@{SEGMENTS}', 'D=M', r'@(?P<i>[01])', 'A=D+A', 'D=M'],
+     lambda g: [f'@{g["seg"]}'] + _offset(int(g['i'])) + ['D=M'],
+     ''),
+
+    # A push immediately popped again leaves D as it was and
+    # A at the stack top
+    (['@SP', 'M=M+1', 'A=M-1', 'M=D', '@SP', 'AM=M-1', 'D=M'],
+     lambda g: ['@SP', 'A=M'],
+     ''),
+
+    (['A=M', 'A=A-1'],
+     lambda g: ['A=M-1'],
+     ''),
+
+    # Constants the ALU can produce directly
+    (['@(?P<c>[01])', 'D=A', '@SP', 'M=M+1', 'A=M-1', 'M=D'],
+     lambda g: ['@SP', 'M=M+1', 'A=M-1', f'M={g["c"]}'],
+     'D'),
+
+    (['D=(?P<c>0|-1)', '@SP', 'M=M+1', 'A=M-1', 'M=D'],
+     lambda g: ['@SP', 'M=M+1', 'A=M-1', f'M={g["c"]}'],
+     'D'),
+
+    (['@1', 'D=A', '@SP', 'A=M-1', r'M=(?P<expr>D\+M|M-D)'],
+     lambda g: ['@SP', 'A=M-1',
+                'M=M+1' if g['expr'] == 'D+M' else 'M=M-1'],
+     'D'),
+]
+
+def _compile(pattern):
+    # Literal instructions stay strings, which are compared
+    # with == rather than through a regex
+    return [re.compile(p) if '(?P<' in p else p for p in pattern]
+
+_RULES = [(_compile(pattern), replace, dead)
+          for pattern, replace, dead in RULES]
+
+
+def _offset(i):
+    # Instructions setting A to M + i, for a segment base
+    # pointer in M
+    if i == 0:
+        return ['A=M']
+    return ['A=M+1'] + ['A=A+1'] * (i - 1)
+
+
+def _fields(line):
+    # dest, comp, jump of a C-instruction
+    dest, _, rest = line.rpartition('=')
+    comp, _, jump = rest.partition(';')
+    return dest, comp, jump
+
+
+def _live(lines, i, register, labels, seen=None):
+    # Whether register ('A' or 'D') may be read by the code
+    # starting at lines[i] before it is overwritten. Anything
+    # that can't be followed counts as a read.
+    if seen is None:
+        seen = set()
+    address = None  # the symbol in A, if set by an @ on this path
+    while i < len(lines):
+        if i in seen:
+            return False
+        seen.add(i)
+
+        line = lines[i]
+        i += 1
+        if line.startswith('('):
+            address = None
+            continue
+        if line.startswith('@'):
+            if register == 'A':
+                return False
+            address = line[1:]
+            continue
+
+        dest, comp, jump = _fields(line)
+        if register in comp:
+            return True
+        if register == 'A' and ('M' in comp or 'M' in dest or jump):
+            return True
+        if jump:
+            target = labels.get(address)
+            if target is None:
+                return True
+            if _live(lines, target, register, labels, seen):
+                return True
+            if jump == 'JMP':
+                return False
+        if register in dest:
+            return False
+        if 'A' in dest:
+            address = None
+    return True
+
+
+def _labels(lines):
+    return {line[1:-1]: i for i, line in enumerate(lines)
+            if line.startswith('(')}
+
+
+def _match(pattern, lines, i):
+    # The named groups of pattern matched at lines[i], or None
+    groups = {}
+    for element in pattern:
+        line = lines[i]
+        i += 1
+        if isinstance(element, str):
+            if line != element:
+                return None
+        else:
+            match = element.fullmatch(line)
+            if match is None:
+                return None
+            groups.update(match.groupdict())
+    return groups
+
+
+def _apply(lines, pattern, replace, dead):
+    # Candidate windows are found by looking for the first
+    # literal instruction in the pattern, which is much
+    # cheaper than trying the pattern at every line
+    k, literal = next((k, element) for k, element in enumerate(pattern)
+                      if isinstance(element, str))
+    n = len(pattern)
+    starts = [i - k for i, line in enumerate(lines)
+              if line == literal and k <= i <= len(lines) - n + k]
+
+    labels = None
+    out = []
+    done = 0  # lines[:done] have been copied or replaced
+    for i in starts:
+        if i < done:
+            continue
+        groups = _match(pattern, lines, i)
+        if groups is None:
+            continue
+        if dead:
+            if labels is None:
+                labels = _labels(lines)
+            if any(_live(lines, i + n, register, labels)
+                   for register in dead):
+                continue
+        out.extend(lines[done:i])
+        out.extend(replace(groups))
+        done = i + n
+
+    if not done:
+        return lines
+    out.extend(lines[done:])
+    return out
+
+
+def _drop_reloads(lines):
+    # An @X when A is already known to hold X
+    out = []
+    address = None
+    for line in lines:
+        if line.startswith('('):
+            address = None
+        elif line.startswith('@'):
+            if line[1:] == address:
+                continue
+            address = line[1:]
+        elif 'A' in _fields(line)[0]:
+            address = None
+        out.append(line)
+    return out
+
+
+def _drop_dead_a(lines):
+    # @X or A=... with nothing reading the A they set
+    labels = _labels(lines)
+    out = []
+    for i, line in enumerate(lines):
+        if line.startswith('@'):
+            sets_only_a = True
+        elif line.startswith('('):
+            sets_only_a = False
+        else:
+            dest, _, jump = _fields(line)
+            sets_only_a = dest == 'A' and not jump
+        if sets_only_a and not _live(lines, i + 1, 'A', labels):
+            continue
+        out.append(line)
+    return out
+
+
+def _until_unchanged(lines, passes):
+    while True:
+        before = lines
+        for apply in passes:
+            lines = apply(lines)
+        if lines == before:
+            return lines
+
+
+def optimize(lines):
+    # The rules all expect CodeWriter's @SP before each stack
+    # access, so they run until none of them changes anything
+    # before any @ is dropped
+    lines = _until_unchanged(lines, [
+        lambda lines, rule=rule: _apply(lines, *rule) for rule in _RULES])
+    return _until_unchanged(lines, [_drop_reloads, _drop_dead_a])
+
+
+def instruction_count(lines):
+    return sum(1 for line in lines if not line.startswith('('))
@@ -0,0 +1,397 @@
+##########################################################
+# Keeping the top of the VM stack in registers
+#
+# CodeWriter translates every push into a store at RAM[SP]
+# and every pop into a load from it, so even
+#
+#   push local 0, push constant 1, add, pop local 0
+#
+# goes through memory four times and costs 49
+# instructions. Within a straight-line run of push, pop and
+# arithmetic commands the stack depth at every command is
+# known while translating, so StackAllocator keeps a
+# compile-time model of the values pushed since the run
+# began instead, and only generates code when a value is
+# used. The example above becomes
+#
+#   @LCL A=M D=M D=D+1 @LCL A=M M=D
+#
+# Each value above the real stack is one of:
+#
+#   an int          a constant, folded with other constants
+#                   and otherwise used straight from A
+#   'D'             the value is in D
+#   'R13', 'R14'    the value was moved out of D to make room
+#   (pointer, i)    a value still in memory, at RAM[pointer]
+#                   + i (LCL, ARG, THIS or THAT), or at the
+#                   fixed address i when pointer is None.
+#                   Only ever the top value, so it is read
+#                   before anything can store to memory.
+#
+# The values are in stack order, so whatever the model
+# doesn't hold is on the real stack below them. When
+# registers run out the bottom of the model is written to
+# the real stack, and CodeWriter calls flush before every
+# label, jump, call and return so the real stack is
+# complete wherever control can arrive from elsewhere. R15
+# is kept free to hold D while that happens.
+#
+# Like the peephole optimizer this relies on stack memory
+# at or above SP being dead, and on no segment pointing
+# into it.
+##########################################################
+
+SCRATCH = ['R13', 'R14']
+
+POINTERS = {
+    'local': 'LCL',
+    'argument': 'ARG',
+    'this': 'THIS',
+    'that': 'THAT',
+}
+POINTER_OFFSET = 3
+TEMP_OFFSET = 5
+
+# Segment offsets up to this are reached with A=A+1 steps,
+# which leave D alone
+CHAIN_LIMIT = 6
+
+# Constants the ALU produces without loading A
+SMALL = {0: '0', 1: '1', 0xFFFF: '-1'}
+
+OPERATORS = {
+    'add': '+',
+    'sub': '-',
+    'and': '&',
+    'or':  '|',
+}
+COMPARISONS = {
+    'eq': 'JEQ',
+    'gt': 'JGT',
+    'lt': 'JLT',
+}
+UNARY = {
+    'neg': '-',
+    'not': '!',
+}
+
+
+def _signed(word):
+    return word - 0x10000 if word & 0x8000 else word
+
+def fold(command, *operands):
+    # What command computes on constant operands, with the
+    # same 16-bit wrap-around as the generated code, which
+    # compares by subtracting
+    if command == 'neg':
+        return -operands[0] & 0xFFFF
+    if command == 'not':
+        return ~operands[0] & 0xFFFF
+
+    x, y = operands
+    if command == 'add':
+        return (x + y) & 0xFFFF
+    if command == 'sub':
+        return (x - y) & 0xFFFF
+    if command == 'and':
+        return x & y
+    if command == 'or':
+        return x | y
+
+    difference = _signed((x - y) & 0xFFFF)
+    true = {
+        'eq': difference == 0,
+        'gt': difference > 0,
+        'lt': difference < 0,
+    }[command]
+    return 0xFFFF if true else 0
+
+
+class StackAllocator:
+    def __init__(self, write, next_label, static_name):
+        # write emits one line of assembly; next_label makes
+        # the labels for comparisons
+        self.write = write
+        self.next_label = next_label
+        self.static_name = static_name
+        self.stack = []
+
+    def push(self, segment: str, index: int) -> None:
+        self._settle()
+        if segment == 'constant':
+            self.stack.append(index)
+            return
+
+        location = self._location(segment, index)
+        if self._address(location) is not None:
+            self.stack.append(location)
+        else:
+            self._release_d()
+            self._load_d(location)
+            self.stack.append('D')
+
+    def pop(self, segment: str, index: int) -> None:
+        self._pull()
+        value = self.stack[-1]
+        location = self._location(segment, index)
+        address = self._address(location)
+
+        if address is not None:
+            if value in SMALL:
+                self._emit(address + [f'M={SMALL[value]}'])
+            else:
+                self._top_to_d()
+                self._emit(address + ['M=D'])
+        else:
+            # Too far into the segment for a chain of A=A+1,
+            # and the address needs D. With the address in D and
+            # the value in M, D=D+M A=D-M M=D-A stores the value
+            # without another register.
+            pointer, offset = location
+            if value in SMALL:
+                self._release_d()
+                self._emit([f'@{pointer}', 'D=M', f'@{offset}', 'A=D+A',
+                            f'M={SMALL[value]}'])
+            else:
+                if value not in SCRATCH:
+                    self._top_to_d()
+                    self._emit(['@R15', 'M=D'])
+                    value = 'R15'
+                else:
+                    self._release_d()
+                self._emit([f'@{pointer}', 'D=M', f'@{offset}', 'D=D+A',
+                            f'@{value}', 'D=D+M', 'A=D-M', 'M=D-A'])
+        self.stack.pop()
+
+    def arithmetic(self, command: str) -> None:
+        if command in UNARY:
+            self._unary(command)
+        else:
+            self._binary(command)
+
+    def pop_to_d(self) -> None:
+        # Pop the top value into D with everything below it on
+        # the real stack, as needed before a conditional jump
+        self._pull()
+        self._top_to_d()
+        self._spill(keep=1)
+        self.stack.pop()
+
+    def flush(self) -> None:
+        # Write every value the model holds to the real stack
+        self._spill(keep=0)
+
+    def _unary(self, command):
+        op = UNARY[command]
+        if not self.stack:
+            self._emit(['@SP', 'A=M-1', f'M={op}M'])
+            return
+
+        value = self.stack[-1]
+        if isinstance(value, int):
+            self.stack[-1] = fold(command, value)
+        elif value == 'D':
+            self._emit([f'D={op}D'])
+        else:
+            self._release_d()
+            self._emit(self._operand(value) + [f'D={op}M'])
+            self.stack[-1] = 'D'
+
+    def _binary(self, command):
+        if len(self.stack) >= 2 and all(isinstance(value, int)
+                                        for value in self.stack[-2:]):
+            y = self.stack.pop()
+            self.stack[-1] = fold(command, self.stack[-1], y)
+            return
+
+        # Comparisons subtract and then jump on the difference
+        op = OPERATORS.get(command, '-')
+        self._pull()
+
+        if len(self.stack) == 1:
+            # x is at the top of the real stack
+            y = self.stack.pop()
+            if isinstance(y, int):
+                self._emit(['@SP', 'AM=M-1', 'D=M'])
+                self._d_op_constant(op, y)
+            else:
+                if y != 'D':
+                    self._load_d(y)
+                self._emit(['@SP', 'AM=M-1', self._combine(op, 'M', False)])
+        else:
+            x, y = self.stack[-2:]
+            if y == 'D':
+                if isinstance(x, int):
+                    self._constant_op_d(op, x)
+                else:
+                    self._emit(self._operand(x) + [self._combine(op, 'M', False)])
+            else:
+                if x != 'D':
+                    self._release_d()
+                    self._load_d(x)
+                if isinstance(y, int):
+                    self._d_op_constant(op, y)
+                else:
+                    self._emit(self._operand(y) + [self._combine(op, 'M', True)])
+            del self.stack[-2:]
+
+        if command in COMPARISONS:
+            true_label = self.next_label('TRUE')
+            after_label = self.next_label('AFTER')
+            self._emit([f'@{true_label}', f'D;{COMPARISONS[command]}',
+                        'D=0', f'@{after_label}', '0;JMP',
+                        f'({true_label})', 'D=-1', f'({after_label})'])
+        self.stack.append('D')
+
+    def _combine(self, op, source, d_first):
+        # The instruction computing D op source if d_first,
+        # else source op D
+        if op == '-':
+            return 'D=D-' + source if d_first else f'D={source}-D'
+        return f'D=D{op}{source}'
+
+    def _d_op_constant(self, op, constant):
+        # D = D op constant
+        if op == '+' and constant in (1, 0xFFFF):
+            self._emit(['D=D+1' if constant == 1 else 'D=D-1'])
+        elif op == '-' and constant in (1, 0xFFFF):
+            self._emit(['D=D-1' if constant == 1 else 'D=D+1'])
+        elif constant == 0 and op in '+-|':
+            pass
+        elif constant == 0xFFFF and op == '&':
+            pass
+        elif constant in (0, 0xFFFF):
+            # 0 & D or -1 | D
+            self._emit([f'D={SMALL[constant]}'])
+        else:
+            self._emit(self._constant_in_a(constant) +
+                       [self._combine(op, 'A', True)])
+
+    def _constant_op_d(self, op, constant):
+        # D = constant op D
+        if op != '-':
+            self._d_op_constant(op, constant)
+        elif constant == 0:
+            self._emit(['D=-D'])
+        else:
+            self._emit(self._constant_in_a(constant) + ['D=A-D'])
+
+    def _constant_in_a(self, constant):
+        if constant <= 0x7FFF:
+            return [f'@{constant}']
+        return [f'@{~constant & 0xFFFF}', 'A=!A']
+
+    def _location(self, segment, index):
+        if segment == 'pointer':
+            return None, POINTER_OFFSET + index
+        if segment == 'temp':
+            return None, TEMP_OFFSET + index
+        if segment == 'static':
+            return None, f'{self.static_name}.{index}'
+        return POINTERS[segment], index
+
+    def _address(self, location):
+        # Instructions setting A to location without touching
+        # D, or None if it is too far into its segment
+        pointer, offset = location
+        if pointer is None:
+            return [f'@{offset}']
+        if offset > CHAIN_LIMIT:
+            return None
+        if offset == 0:
+            return [f'@{pointer}', 'A=M']
+        return [f'@{pointer}', 'A=M+1'] + ['A=A+1'] * (offset - 1)
+
+    def _operand(self, value):
+        # Instructions making M the value of a scratch register
+        # or memory location
+        if isinstance(value, tuple):
+            return self._address(value)
+        return [f'@{value}']
+
+    def _load_d(self, value):
+        # D = value, whatever D held before
+        if isinstance(value, int):
+            if value in SMALL:
+                self._emit([f'D={SMALL[value]}'])
+            elif value <= 0x7FFF:
+                self._emit([f'@{value}', 'D=A'])
+            else:
+                self._emit([f'@{~value & 0xFFFF}', 'D=!A'])
+        elif isinstance(value, tuple) and value[0] is not None \
+                and value[1] > 2:
+            pointer, offset = value
+            self._emit([f'@{pointer}', 'D=M', f'@{offset}', 'A=D+A', 'D=M'])
+        elif value != 'D':
+            self._emit(self._operand(value) + ['D=M'])
+
+    def _needs_d(self, value):
+        # Whether writing value to the stack goes through D
+        return value not in SMALL and value != 'D'
+
+    def _pull(self):
+        # Make sure the model holds at least the top value
+        if not self.stack:
+            self._emit(['@SP', 'AM=M-1', 'D=M'])
+            self.stack.append('D')
+
+    def _settle(self):
+        # A value still in memory is loaded before another is
+        # pushed on top of it
+        if self.stack and isinstance(self.stack[-1], tuple):
+            self._top_to_d()
+
+    def _top_to_d(self):
+        if self.stack[-1] == 'D':
+            return
+        self._release_d()
+        self._load_d(self.stack[-1])
+        self.stack[-1] = 'D'
+
+    def _release_d(self):
+        # Move a value out of D, to a free scratch register or,
+        # failing that, onto the real stack with everything
+        # below it. Never moves the top value, which callers
+        # only do this for when it isn't in D.
+        if 'D' not in self.stack:
+            return
+        i = self.stack.index('D')
+        register = next((r for r in SCRATCH if r not in self.stack), None)
+        if register is not None:
+            self._emit([f'@{register}', 'M=D'])
+            self.stack[i] = register
+        else:
+            self._spill(keep=len(self.stack) - i - 1)
+
+    def _spill(self, keep):
+        # Write all but the top keep values to the real stack,
+        # bottom first
+        values = self.stack[:len(self.stack) - keep]
+        if not values:
+            return
+        kept = self.stack[len(values):]
+
+        if 'D' in values:
+            i = values.index('D')
+            if any(self._needs_d(value) for value in values[:i]):
+                self._emit(['@R15', 'M=D'])
+                values[i] = 'R15'
+        preserve = 'D' in kept and any(self._needs_d(value)
+                                       for value in values)
+        if preserve:
+            self._emit(['@R15', 'M=D'])
+
+        for value in values:
+            if value in SMALL:
+                self._emit(['@SP', 'M=M+1', 'A=M-1', f'M={SMALL[value]}'])
+            else:
+                self._load_d(value)
+                self._emit(['@SP', 'M=M+1', 'A=M-1', 'M=D'])
+
+        if preserve:
+            self._emit(['@R15', 'D=M'])
+        self.stack = kept
+
+    def _emit(self, lines):
+        for line in lines:
+            self.write(line)
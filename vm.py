@@ -1,8 +1,17 @@
+import glob
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from pathlib import Path
 from dataclasses import dataclass
 from collections.abc import Callable
 
+import peephole
+from stackalloc import StackAllocator
+
+logger = logging.getLogger(__name__)
+
 class CommandType(Enum):
     ARITHMETIC = 1
     PUSH = 2
@@ -59,6 +68,29 @@ class Parser:
                 arg1=command
             )
 
+        elif command in ['label', 'goto', 'if-goto']:
+            return VMCommand(
+                type={
+                    'label': CommandType.LABEL,
+                    'goto': CommandType.GOTO,
+                    'if-goto': CommandType.IF,
+                }[command],
+                arg1=splat[1]
+            )
+
+        elif command in ['function', 'call']:
+            return VMCommand(
+                type=CommandType.FUNCTION if command == 'function' else CommandType.CALL,
+                arg1=splat[1],
+                arg2=int(splat[2])
+            )
+
+        elif command == 'return':
+            return VMCommand(
+                type=CommandType.RETURN,
+                arg1=command
+            )
+
 
 segment2symbol = {
     'local': 'LCL',
@@ -70,11 +102,42 @@ segment2symbol = {
 class CodeWriter:
     POINTER_OFFSET = 3
     TEMP_OFFSET = 5
+    # Assembly lines are collected in a buffer and written out
+    # in chunks of this many lines
+    BUFFER_LINES = 8192
     
-    def __init__(self, output_file: Path):
+    def __init__(self, output_file: Path, optimize: bool = False,
+                 shared_compare: bool = False, inline_calls: bool = False,
+                 registers: bool = False, namespace: str = ''):
+        # With optimize=True the whole program is kept in the
+        # buffer and run through the peephole optimizer before
+        # it is written. With shared_compare=True eq/gt/lt call
+        # one shared routine per operator, emitted after the
+        # program, instead of being inlined. call and return
+        # always go through shared routines unless inline_calls
+        # is set, which expands them at every use the way the
+        # book does. With registers=True push, pop and
+        # arithmetic go through a StackAllocator, which keeps
+        # values in registers and folds constants until the
+        # next label, jump, call or return. namespace is put in
+        # front of every label the writer makes up, so that the
+        # labels of separately translated files never clash.
         self.output_file = output_file
+        self.file = None
         self.static_name = output_file.stem
-        self.next_label = self._create_label_maker()
+        self.function_name = self.static_name
+        self.next_label = self._create_label_maker(namespace)
+        self.return_count = 0
+        self.optimize = optimize
+        self.shared_compare = shared_compare
+        self.inline_calls = inline_calls
+        self.compare_routines = set()
+        self.call_routines = set()
+        self.return_routine = False
+        self.buffer = []
+        self.allocator = StackAllocator(self._write, self.next_label,
+                                        self.static_name) \
+                         if registers else None
 
     def __enter__(self):
         self.file = open(self.output_file, 'w')
@@ -82,10 +145,60 @@ class CodeWriter:
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         if self.file:
+            self._end_region()
             self._write_end_loop()
+            self._write_compare_routines()
+            self._write_call_routines()
+            self._write_return_routine()
+            self.flush()
             self.file.close()
 
+    def end_fragment(self) -> list[str]:
+        # Take the lines written so far from a writer used
+        # without an output file, ending the current region and
+        # optimizing them if asked to. The shared routines they
+        # call are left to the writer of the whole program.
+        self._end_region()
+        lines = self.buffer
+        if self.optimize:
+            lines = peephole.optimize(lines)
+        self.buffer = []
+        return lines
+
+    def write_fragment(self, fragment: 'Fragment') -> None:
+        # Write out a file translated by another writer, as it
+        # is, and remember the shared routines it calls
+        self._end_region()
+        self.flush()
+        self.file.write('\n'.join(fragment.lines + ['']))
+        self.compare_routines |= fragment.compare_routines
+        self.call_routines |= fragment.call_routines
+        self.return_routine |= fragment.return_routine
+
+    def flush(self) -> None:
+        if self.buffer:
+            if self.optimize:
+                self.buffer = peephole.optimize(self.buffer)
+            self.buffer.append('')
+            self.file.write('\n'.join(self.buffer))
+            self.buffer = []
+
+    def write_init(self) -> None:
+        # SP = 256, then call Sys.init. The return address is
+        # scoped under a name no VM function can have.
+        self.function_name = '$bootstrap'
+        self._store_value_in_d(256)
+        self._set_address('SP')
+        self._write('M=D')
+        self.write_call('Sys.init', 0)
+
     def write_arithmetic(self, command: str) -> None:
+        if self.allocator:
+            if not (self.shared_compare and command in ['eq', 'gt', 'lt']):
+                self.allocator.arithmetic(command)
+                return
+            self._end_region()
+
         if command == 'add':
             self._write_binary_operation('+')
 
@@ -114,6 +227,13 @@ class CodeWriter:
             self._write_unary_operation('!')
 
     def write_push_pop(self, command, segment: str, index: int) -> None:
+        if self.allocator:
+            if command == CommandType.PUSH:
+                self.allocator.push(segment, index)
+            else:
+                self.allocator.pop(segment, index)
+            return
+
         if command == CommandType.PUSH:
             if segment == 'constant':
                 self._push_constant_to_stack(constant=index)
@@ -123,6 +243,223 @@ class CodeWriter:
         elif command == CommandType.POP:               
             self._pop_stack_to_memory(segment, index)
 
+    def write_label(self, label: str) -> None:
+        self._end_region()
+        self._write_label(self._scoped_label(label))
+
+    def write_goto(self, label: str) -> None:
+        self._end_region()
+        self._set_address(self._scoped_label(label))
+        self._write('0;JMP')
+
+    def write_if(self, label: str) -> None:
+        if self.allocator:
+            self.allocator.pop_to_d()
+        else:
+            self._pop_stack_to_d()
+        self._set_address(self._scoped_label(label))
+        self._write('D;JNE')
+
+    def write_function(self, function_name: str, n_locals: int) -> None:
+        self._end_region()
+        self.function_name = function_name
+        self._write_label(function_name)
+
+        if self.inline_calls:
+            for _ in range(n_locals):
+                self._push_constant_to_stack(0)
+            return
+
+        # The locals are zeroed in place and SP moved once,
+        # rather than pushing a 0 for each
+        if n_locals == 1:
+            self._set_address('SP')
+            self._write('M=M+1')
+            self._write('A=M-1')
+            self._write('M=0')
+        elif n_locals > 1:
+            self._set_address('SP')
+            self._write('A=M')
+            self._write('M=0')
+            for _ in range(n_locals - 1):
+                self._write('A=A+1')
+                self._write('M=0')
+            self._write('D=A+1')
+            self._set_address('SP')
+            self._write('M=D')
+
+    def write_call(self, function_name: str, n_args: int) -> None:
+        self._end_region()
+        return_label = f'{self.function_name}$ret.{self.return_count}'
+        self.return_count += 1
+
+        if self.inline_calls:
+            self._write_inline_call(function_name, n_args, return_label)
+            return
+
+        # Jump to the shared routine for n_args arguments with
+        # the function's address in R13 and the return address
+        # in D
+        self.call_routines.add(n_args)
+        self._store_value_in_d(function_name)
+        self._set_address('R13')
+        self._write('M=D')
+        self._store_value_in_d(return_label)
+        self._set_address(f'CALL_{n_args}')
+        self._write('0;JMP')
+        self._write_label(return_label)
+
+    def write_return(self) -> None:
+        self._end_region()
+        if self.inline_calls:
+            self._write_inline_return()
+            return
+
+        self.return_routine = True
+        self._set_address('RETURN')
+        self._write('0;JMP')
+
+    def _end_region(self) -> None:
+        # Everything the allocator holds goes to the real stack
+        # before control can arrive from or leave for elsewhere
+        if self.allocator:
+            self.allocator.flush()
+
+    def _scoped_label(self, label: str) -> str:
+        return f'{self.function_name}${label}'
+
+    def _write_inline_call(self, function_name: str, n_args: int,
+                           return_label: str) -> None:
+        self._push_constant_to_stack(return_label)
+        for symbol in ['LCL', 'ARG', 'THIS', 'THAT']:
+            self._set_address(symbol)
+            self._write('D=M')
+            self._push_d_to_stack()
+
+        # ARG = SP - 5 - n_args
+        self._set_address('SP')
+        self._write('D=M')
+        self._set_address(5 + n_args)
+        self._write('D=D-A')
+        self._set_address('ARG')
+        self._write('M=D')
+
+        # LCL = SP
+        self._set_address('SP')
+        self._write('D=M')
+        self._set_address('LCL')
+        self._write('M=D')
+
+        self._set_address(function_name)
+        self._write('0;JMP')
+        self._write_label(return_label)
+
+    def _write_inline_return(self) -> None:
+        # R14 = frame = LCL, R15 = return address = *(frame - 5)
+        self._set_address('LCL')
+        self._write('D=M')
+        self._set_address('R14')
+        self._write('M=D')
+        self._set_address(5)
+        self._write('A=D-A')
+        self._write('D=M')
+        self._set_address('R15')
+        self._write('M=D')
+
+        # *ARG = pop, SP = ARG + 1
+        self._pop_stack_to_d()
+        self._set_address('ARG')
+        self._write('A=M')
+        self._write('M=D')
+        self._set_address('ARG')
+        self._write('D=M+1')
+        self._set_address('SP')
+        self._write('M=D')
+
+        for symbol in ['THAT', 'THIS', 'ARG', 'LCL']:
+            self._set_address('R14')
+            self._write('AM=M-1')
+            self._write('D=M')
+            self._set_address(symbol)
+            self._write('M=D')
+
+        self._set_address('R15')
+        self._write('A=M')
+        self._write('0;JMP')
+
+    def _write_call_routines(self) -> None:
+        # One routine per argument count used. Each pushes the
+        # return address it was given in D and the caller's
+        # LCL, ARG, THIS and THAT, points ARG at the arguments
+        # and LCL at the new frame, and jumps to the function
+        # whose address is in R13.
+        for n_args in sorted(self.call_routines):
+            self._write_label(f'CALL_{n_args}')
+            self._set_address('SP')
+            self._write('A=M')
+            self._write('M=D')
+            for symbol in ['LCL', 'ARG', 'THIS', 'THAT']:
+                self._set_address(symbol)
+                self._write('D=M')
+                self._set_address('SP')
+                self._write('AM=M+1')
+                self._write('M=D')
+
+            # SP is left at the last word pushed, so one more
+            # increment gives the new LCL
+            self._set_address('SP')
+            self._write('MD=M+1')
+            self._set_address('LCL')
+            self._write('M=D')
+            self._set_address(5 + n_args)
+            self._write('D=D-A')
+            self._set_address('ARG')
+            self._write('M=D')
+
+            self._set_address('R13')
+            self._write('A=M')
+            self._write('0;JMP')
+
+    def _write_return_routine(self) -> None:
+        # The return address is read before the return value is
+        # stored, since with no arguments *ARG is where it was
+        # saved. LCL walks down the saved frame and is restored
+        # last.
+        if not self.return_routine:
+            return
+
+        self._write_label('RETURN')
+        self._store_value_in_d(5)
+        self._set_address('LCL')
+        self._write('A=M-D')
+        self._write('D=M')
+        self._set_address('R14')
+        self._write('M=D')
+
+        self._pop_stack_to_d()
+        self._set_address('ARG')
+        self._write('A=M')
+        self._write('M=D')
+        self._write('D=A+1')
+        self._set_address('SP')
+        self._write('M=D')
+
+        for symbol in ['THAT', 'THIS', 'ARG']:
+            self._set_address('LCL')
+            self._write('AM=M-1')
+            self._write('D=M')
+            self._set_address(symbol)
+            self._write('M=D')
+        self._set_address('LCL')
+        self._write('A=M-1')
+        self._write('D=M')
+        self._set_address('LCL')
+        self._write('M=D')
+
+        self._set_address('R14')
+        self._write('A=M')
+        self._write('0;JMP')
+
     def _write_binary_operation(self, op: str) -> None:
         self._pop_stack_to_variable('R13')
         self._pop_stack_to_d()
@@ -144,6 +481,10 @@ class CodeWriter:
             '<':  'JLT',
         }[op]
 
+        if self.shared_compare:
+            self._write_compare_call(jump_op)
+            return
+
         self._pop_stack_to_variable('R13')
         self._pop_stack_to_d()
 
@@ -172,6 +513,45 @@ class CodeWriter:
 
         self._write_label(after_label)
 
+    def _write_compare_call(self, jump_op: str) -> None:
+        # Jump to the shared routine with the return address in D
+        self.compare_routines.add(jump_op)
+        return_label = self.next_label('RETURN')
+        self._store_value_in_d(return_label)
+        self._set_address(f'COMPARE_{jump_op}')
+        self._write('0;JMP')
+        self._write_label(return_label)
+
+    def _write_compare_routines(self) -> None:
+        # One routine per comparison used, each popping two
+        # values, pushing the result and jumping back to the
+        # return address it was given in D (kept in R15, since
+        # the pops use R13)
+        for jump_op in sorted(self.compare_routines):
+            routine = f'COMPARE_{jump_op}'
+            self._write_label(routine)
+            self._set_address('R15')
+            self._write('M=D')
+
+            self._pop_stack_to_variable('R13')
+            self._pop_stack_to_d()
+            self._set_address('R13')
+            self._write('D=D-M')
+
+            self._set_address(f'{routine}_TRUE')
+            self._write(f'D;{jump_op}')
+            self._write('D=0')
+            self._set_address(f'{routine}_PUSH')
+            self._write('0;JMP')
+            self._write_label(f'{routine}_TRUE')
+            self._write('D=-1')
+            self._write_label(f'{routine}_PUSH')
+            self._push_d_to_stack()
+
+            self._set_address('R15')
+            self._write('A=M')
+            self._write('0;JMP')
+
     def _push_constant_to_stack(self, constant: int) -> None:
         self._store_value_in_d(constant)
         self._push_d_to_stack()
@@ -268,46 +648,227 @@ class CodeWriter:
         self._write(f'@{addr}')
 
     def _write(self, text: str) -> None:
-        self.file.write(text + '\n')
+        self.buffer.append(text)
+        if len(self.buffer) >= self.BUFFER_LINES and self.file \
+                and not self.optimize:
+            self.flush()
 
     def _generate_label(self) -> None:
         return ''.join(random.choices(string.ascii_uppercase, k=10))
 
-    def _create_label_maker(self) -> Callable[[], str]:
+    def _create_label_maker(self, namespace: str = '') -> Callable[[], str]:
         index = -1
 
         def next_label(prefix: str = 'LABEL') -> str:
             nonlocal index
             index += 1
-            return f'{prefix}{index}'
+            return f'{namespace}{prefix}{index}'
         
         return next_label
 
 
 
 class VMTranslator:
-    def __init__(self, input_file: str):
+    def __init__(self, input_file: str, optimize: bool = False,
+                 shared_compare: bool = False, inline_calls: bool = False,
+                 registers: bool = False, jobs: int = 1):
+        # A directory is translated into one .asm file named
+        # after it, starting with the bootstrap code that calls
+        # Sys.init, with its files translated by jobs worker
+        # processes (see translate_all); a single .vm file is
+        # translated as it is
         input_path = Path(input_file)
-        output_path = input_path.with_suffix('.asm')
-
-        with Parser(input_file) as parser, CodeWriter(output_path) as writer:
-            for cmd in parser:
-                print(f'Parsed {cmd.type} command with args: {(cmd.arg1, cmd.arg2)}')
+        options = dict(optimize=optimize, shared_compare=shared_compare,
+                       inline_calls=inline_calls, registers=registers)
+        if input_path.is_dir():
+            translate_all([input_path],
+                          input_path / f'{input_path.name}.asm',
+                          jobs, **options)
+            return
+
+        with CodeWriter(input_path.with_suffix('.asm'), **options) as writer, \
+             Parser(input_path) as parser:
+            _translate(parser, writer)
+
+
+def _translate(parser: Parser, writer: CodeWriter) -> None:
+    # Checked once up front, since even a disabled logger
+    # call per command is measurable on large inputs
+    log_commands = logger.isEnabledFor(logging.DEBUG)
+
+    for cmd in parser:
+        if log_commands:
+            logger.debug('Parsed %s command with args: %s',
+                         cmd.type, (cmd.arg1, cmd.arg2))
+
+        if cmd.type in [CommandType.PUSH, CommandType.POP]:
+            writer.write_push_pop(
+                command=cmd.type,
+                segment=cmd.arg1,
+                index=cmd.arg2,
+            )
 
-                if cmd.type in [CommandType.PUSH, CommandType.POP]:
-                    writer.write_push_pop(
-                        command=cmd.type,
-                        segment=cmd.arg1,
-                        index=cmd.arg2,
-                    )
+        elif cmd.type == CommandType.ARITHMETIC:
+            writer.write_arithmetic(
+                command=cmd.arg1
+            )
 
-                elif cmd.type == CommandType.ARITHMETIC:
-                    writer.write_arithmetic(
-                        command=cmd.arg1
-                    )
+        elif cmd.type == CommandType.LABEL:
+            writer.write_label(cmd.arg1)
+
+        elif cmd.type == CommandType.GOTO:
+            writer.write_goto(cmd.arg1)
+
+        elif cmd.type == CommandType.IF:
+            writer.write_if(cmd.arg1)
+
+        elif cmd.type == CommandType.FUNCTION:
+            writer.write_function(cmd.arg1, cmd.arg2)
+
+        elif cmd.type == CommandType.CALL:
+            writer.write_call(cmd.arg1, cmd.arg2)
+
+        elif cmd.type == CommandType.RETURN:
+            writer.write_return()
+
+
+##########################################################
+# Translating many files
+#
+# Apart from static variables, which are named after their
+# file anyway, the only thing the translations of separate
+# .vm files share is the counter CodeWriter numbers its
+# labels with. Giving each file's writer a namespace of its
+# own ($ followed by the file name, which no VM function
+# or label can start with) makes every file's translation
+# independent of the others, so they can be done in any
+# order, in worker processes, and merged afterwards in the
+# order the files were given. The bootstrap code, the end
+# loop and the shared routines are written once, by the
+# writer of the merged program, so its output is the same
+# byte for byte whatever the number of workers.
+##########################################################
+
+class Fragment:
+    __slots__ = ('vm_path', 'lines', 'compare_routines', 'call_routines',
+                 'return_routine', 'seconds')
+
+    def __init__(self, vm_path, lines, compare_routines, call_routines,
+                 return_routine, seconds):
+        self.vm_path = vm_path
+        self.lines = lines
+        self.compare_routines = compare_routines
+        self.call_routines = call_routines
+        self.return_routine = return_routine
+        self.seconds = seconds
+
+
+def find_vm_files(inputs):
+    # Each input is a directory (all the .vm files in it), a
+    # glob pattern or a plain path
+    paths = []
+    for inp in inputs:
+        if Path(inp).is_dir():
+            paths.extend(sorted(Path(inp).glob('*.vm')))
+        elif glob.has_magic(str(inp)):
+            paths.extend(sorted(Path(p) for p in glob.glob(str(inp))))
+        else:
+            paths.append(Path(inp))
+    return paths
+
+
+def translate_fragment(vm_path, options):
+    start = time.perf_counter()
+    vm_path = Path(vm_path)
+    writer = CodeWriter(vm_path.with_suffix('.asm'),
+                        namespace=f'${vm_path.stem}.', **options)
+    with Parser(vm_path) as parser:
+        _translate(parser, writer)
+    return Fragment(vm_path, writer.end_fragment(), writer.compare_routines,
+                    writer.call_routines, writer.return_routine,
+                    time.perf_counter() - start)
+
+
+def _translate_file(vm_path, options):
+    with CodeWriter(vm_path.with_suffix('.asm'), **options) as writer, \
+         Parser(vm_path) as parser:
+        _translate(parser, writer)
+    return writer.output_file
+
+
+def translate_all(inputs, output_path=None, jobs=None, **options):
+    # Translate the .vm files found in inputs (see
+    # find_vm_files) with the CodeWriter options given. With
+    # output_path they are merged into one program there,
+    # starting with the bootstrap code; otherwise each is
+    # written to its own .asm file as a single file would be.
+    # Returns the paths written. jobs is the number of worker
+    # processes, defaulting to one per core; jobs=1 translates
+    # everything in this process.
+    paths = find_vm_files(inputs)
+    if output_path is None:
+        work, args = _translate_file, (paths, [options] * len(paths))
+    else:
+        stems = [path.stem for path in paths]
+        duplicates = sorted({stem for stem in stems if stems.count(stem) > 1})
+        if duplicates:
+            raise ValueError(f'More than one file named {duplicates[0]}.vm; '
+                             f'their static variables would clash')
+        work, args = translate_fragment, (paths, [options] * len(paths))
+
+    if jobs == 1:
+        results = list(map(work, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(work, *args))
+
+    if output_path is None:
+        return results
+
+    with CodeWriter(Path(output_path), **options) as writer:
+        writer.write_init()
+        for fragment in results:
+            logger.debug('Translated %s in %.3fs', fragment.vm_path,
+                         fragment.seconds)
+            writer.write_fragment(fragment)
+    return [Path(output_path)]
 
 
 if __name__ == '__main__':
-    import sys
-    src_file = sys.argv[1]
-    VMTranslator(src_file)
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Translate .vm files into Hack assembly.')
+    parser.add_argument('inputs', nargs='+',
+                        help='.vm files, directories or glob patterns. '
+                             'A directory on its own is translated into '
+                             'one program named after it.')
+    parser.add_argument('-o', '--output',
+                        help='merge every file into one program here')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every parsed command')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='run the peephole optimizer on the output')
+    parser.add_argument('--shared-compare', action='store_true',
+                        help='call shared eq/gt/lt routines instead of '
+                             'inlining them')
+    parser.add_argument('--inline-calls', action='store_true',
+                        help='expand call and return at every use '
+                             'instead of calling shared routines')
+    parser.add_argument('-R', '--registers', action='store_true',
+                        help='keep stack values in registers and fold '
+                             'constants within straight-line code')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.WARNING)
+    options = dict(optimize=args.optimize,
+                   shared_compare=args.shared_compare,
+                   inline_calls=args.inline_calls,
+                   registers=args.registers)
+    if len(args.inputs) == 1 and Path(args.inputs[0]).is_dir() \
+            and not args.output:
+        VMTranslator(args.inputs[0], jobs=args.jobs, **options)
+    else:
+        translate_all(args.inputs, args.output, args.jobs, **options)